@@ -1,10 +1,14 @@
 import numpy as np
 import pandas as pd
-from torch.utils.data import Dataset
+import pyarrow as pa
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
 import re
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 from torch.utils.data import Sampler
 import torch
 import os
+from transformers import BatchEncoding
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 #
 # patterns = [
@@ -49,30 +53,396 @@ def replace_patterns(text):
     return text
 
 
+ellipsis_regex = re.compile(r'[\.]{3,}')
+combined_regex = re.compile(combined_pattern)
+# 任何 pattern 能匹配的文本一定包含的内容：数字、路径分隔符、@、'...'、关键词，或只由字母组成的十六进制串/MAC
+trigger_regex = re.compile(
+    r'[\d/\\@]|\.\.\.|True|true|False|false'
+    r'|\b(zero|one|two|three|four|five|six|seven|eight|nine|ten|eleven|twelve|thirteen|fourteen|fifteen|sixteen|seventeen|eighteen|nineteen|twenty|thirty|forty|fifty|sixty|seventy|eighty|ninety|hundred|thousand|million|billion)\b'
+    r'|\b(Mon|Monday|Tue|Tuesday|Wed|Wednesday|Thu|Thursday|Fri|Friday|Sat|Saturday|Sun|Sunday)\b'
+    r'|\b[a-fA-F]{8}\b|\b[a-fA-F]{10}\b|([a-fA-F]{2}:){5}[a-fA-F]{2}'
+)
+
+
+def normalize_message(text):
+    '''
+    replace_patterns for a single log message, the regexes are skipped when no pattern can match.
+    '''
+    if trigger_regex.search(text) is None:
+        return text
+    return combined_regex.sub('<*>', ellipsis_regex.sub('.. ', text))
+
+
+def normalize_messages(messages):
+    return [normalize_message(message) for message in messages]
+
+
+def normalize_windows(contents, num_workers=None, chunk_size=20000):
+    '''
+    Byte-identical to [replace_patterns(content) for content in contents] (no pattern matches across the ' ;-; '
+    separator), but every unique message is normalized only once, by a pool of `num_workers` processes.
+    :param contents: windows of log messages joined by ' ;-; '.
+    :param num_workers: number of processes, os.cpu_count() if None, 1 normalizes in this process.
+    '''
+    windows = [content.split(' ;-; ') for content in contents]
+    unique_messages = list(dict.fromkeys(message for window in windows for message in window))
+    normalized = dict(zip(unique_messages, normalize_unique_messages(unique_messages, num_workers, chunk_size)))
+    return [' ;-; '.join([normalized[message] for message in window]) for window in windows]
+
+
+def normalize_unique_messages(unique_messages, num_workers=None, chunk_size=20000):
+    '''
+    normalize_message of every message, by a pool of `num_workers` processes (os.cpu_count() if None).
+    '''
+    num_workers = num_workers or os.cpu_count() or 1
+    if num_workers > 1 and len(unique_messages) > chunk_size:
+        chunks = [unique_messages[i:i + chunk_size] for i in range(0, len(unique_messages), chunk_size)]
+        with ProcessPoolExecutor(min(num_workers, len(chunks))) as executor:
+            return [message for chunk in executor.map(normalize_messages, chunks) for message in chunk]
+    return normalize_messages(unique_messages)
+
+
+def read_arrow_table(path):
+    '''
+    Memory-map an uncompressed Arrow IPC (Feather v2) file, the columns are not copied.
+    '''
+    return pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+
+
+def iter_window_positions(windows_path, chunk_size=None):
+    '''
+    Decode the window table written by prepareData.helper.write_window_tables, `chunk_size` windows at a time
+    (all of them in one chunk if None), into positions in the memory-mapped message table it refers to.
+    :return: iterator of (Content column of the message table, offsets of the windows of the chunk into the
+             positions, the message table position of every message of these windows, their labels)
+    '''
+    windows = read_arrow_table(windows_path)
+    messages_file = windows.schema.metadata[b'messages'].decode('utf-8')
+    contents = read_arrow_table(os.path.join(os.path.dirname(windows_path), messages_file)).column('Content')
+    for start in ([0] if chunk_size is None else range(0, windows.num_rows, chunk_size)):
+        chunk = windows.slice(start, chunk_size)
+        if 'message_ids' in chunk.column_names:
+            message_lists = chunk.column('message_ids').combine_chunks()
+            offsets = message_lists.offsets.to_numpy().astype(np.int64)
+            positions = message_lists.flatten().to_numpy()
+            offsets = offsets - offsets[0]
+        else:
+            starts = chunk.column('start').to_numpy().astype(np.int64)
+            lengths = chunk.column('end').to_numpy().astype(np.int64) - starts
+            offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+            positions = np.arange(offsets[-1]) + np.repeat(starts - offsets[:-1], lengths)
+        yield contents, offsets, positions, chunk.column('Label').to_numpy()
+
+
+def load_window_tables(windows_path, num_workers=None):
+    '''
+    Read the window table written by prepareData.helper.write_window_tables and the message table it refers to.
+    Each message is normalized once, however many windows contain it.
+    :return: normalized unique messages, the message id of every position of every window, the window offsets
+             into these ids, and the window labels.
+    '''
+    contents, sequence_offsets, positions, labels = next(iter_window_positions(windows_path))
+
+    # raw message -> normalized message id, computed on the distinct raw messages only
+    encoded = contents.combine_chunks().dictionary_encode()
+    raw_ids = encoded.indices.to_numpy()
+    normalized = normalize_unique_messages(encoded.dictionary.to_pylist(), num_workers)
+    normalized_ids, unique_messages = pd.factorize(np.array(normalized, dtype=object))
+    message_ids = normalized_ids[raw_ids[positions]]
+    return list(unique_messages), message_ids, sequence_offsets, labels
+
+
+class NpyDirectory:
+    '''
+    Arrays kept as .npy files in one directory and opened as read-only memmaps, one attribute per name of `files`.
+    Pickling only keeps the directory, so DataLoader workers attach to the same files (shared page cache) instead
+    of copying the arrays. Subclasses write the files in a build classmethod with _save / _open_memmap, small
+    metadata goes to text files (_write_text / _read_text).
+    '''
+    files = ()
+
+    def __init__(self, directory):
+        self.directory = directory
+        for name in self.files:
+            setattr(self, name, np.load(os.path.join(directory, name + '.npy'), mmap_mode='r'))
+
+    @staticmethod
+    def _save(directory, arrays):
+        os.makedirs(directory, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(os.path.join(directory, name + '.npy'), array)
+
+    @staticmethod
+    def _open_memmap(directory, name, dtype, shape):
+        '''
+        :return: writable memmap of a new .npy file, to be filled in place and flushed.
+        '''
+        os.makedirs(directory, exist_ok=True)
+        return np.lib.format.open_memmap(os.path.join(directory, name + '.npy'), mode='w+', dtype=dtype, shape=shape)
+
+    @staticmethod
+    def _write_text(directory, name, text):
+        with open(os.path.join(directory, name + '.txt'), 'w') as f:
+            f.write(text)
+
+    def _read_text(self, name):
+        with open(os.path.join(self.directory, name + '.txt')) as f:
+            return f.read()
+
+    def __getstate__(self):
+        return {'directory': self.directory}
+
+    def __setstate__(self, state):
+        self.__init__(state['directory'])
+
+
+class EncodedSequences(NpyDirectory):
+    '''
+    Dictionary-encoded log sequences in .npy memmaps (see NpyDirectory), instead of Python lists of strings: the
+    unique messages (utf-8 bytes and offsets), the message id of every position (int32) and the offsets of every
+    sequence.
+    '''
+    files = ('message_bytes', 'message_offsets', 'message_word_counts', 'message_ids', 'sequence_offsets')
+
+    @classmethod
+    def build(cls, sequences, directory):
+        '''
+        :param sequences: lists of messages.
+        :param directory: where the .npy files are written.
+        '''
+        sequence_lengths = np.fromiter((len(seq) for seq in sequences), dtype=np.int64, count=len(sequences))
+        messages = np.fromiter((message for seq in sequences for message in seq), dtype=object,
+                               count=int(sequence_lengths.sum()))
+        message_ids, unique_messages = pd.factorize(messages)
+        sequence_offsets = np.concatenate([[0], np.cumsum(sequence_lengths)])
+        return cls.write(unique_messages, message_ids, sequence_offsets, directory)
+
+    @classmethod
+    def write(cls, unique_messages, message_ids, sequence_offsets, directory):
+        '''
+        :param unique_messages: the message of every message id.
+        :param message_ids: message id of every position of every sequence.
+        :param sequence_offsets: start of every sequence in `message_ids`, followed by its length.
+        '''
+        encoded = [message.encode('utf-8') for message in unique_messages]
+        cls._save(directory, {
+            'message_bytes': np.frombuffer(b''.join(encoded), dtype=np.uint8),
+            'message_offsets': np.concatenate([[0], np.cumsum([len(message) for message in encoded])]).astype(np.int64),
+            'message_word_counts': np.array([len(message.split()) for message in unique_messages], dtype=np.int32),
+            'message_ids': np.asarray(message_ids).astype(np.int32),
+            'sequence_offsets': np.asarray(sequence_offsets).astype(np.int64),
+        })
+        return cls(directory)
+
+    def __len__(self):
+        return len(self.sequence_offsets) - 1
+
+    def num_messages(self):
+        return len(self.message_offsets) - 1
+
+    def sequence_ids(self, idx):
+        return self.message_ids[self.sequence_offsets[idx]:self.sequence_offsets[idx + 1]]
+
+    def message(self, message_id):
+        return bytes(self.message_bytes[self.message_offsets[message_id]:self.message_offsets[message_id + 1]]).decode('utf-8')
+
+    def __getitem__(self, idx):
+        return [self.message(message_id) for message_id in self.sequence_ids(idx)]
+
+    def get_lengths(self):
+        '''
+        :return: number of messages of each sequence, and the number of words of its longest message.
+        '''
+        seq_lengths = np.diff(self.sequence_offsets)
+        word_counts = np.asarray(self.message_word_counts)[self.message_ids]
+        token_lengths = np.zeros(len(seq_lengths), dtype=np.int64)
+        non_empty = seq_lengths > 0
+        if non_empty.any():
+            token_lengths[non_empty] = np.maximum.reduceat(word_counts, self.sequence_offsets[:-1][non_empty])
+        return seq_lengths, token_lengths
+
+
+class TokenStore(NpyDirectory):
+    '''
+    BERT token ids of every unique message of an EncodedSequences, tokenized once with `max_content_len`
+    truncation and kept in int32 .npy memmaps indexed by message id (see NpyDirectory): `token_ids` [number of
+    messages, max_content_len] padded with the pad token, and `lengths`. Used by CustomCollator(token_store=...)
+    instead of calling the tokenizer in every batch.
+    '''
+    files = ('token_ids', 'lengths')
+
+    def __init__(self, directory):
+        super().__init__(directory)
+        self.pad_token_id = int(self._read_text('pad_token_id'))
+
+    @classmethod
+    def build(cls, sequences, tokenizer, max_content_len, directory, chunk_size=10000):
+        '''
+        :param sequences: EncodedSequences whose messages are tokenized.
+        :param directory: where the .npy files are written.
+        '''
+        num_messages = sequences.num_messages()
+        token_ids = cls._open_memmap(directory, 'token_ids', np.int32, (num_messages, max_content_len))
+        lengths = cls._open_memmap(directory, 'lengths', np.int32, (num_messages,))
+        for start in range(0, num_messages, chunk_size):
+            end = min(start + chunk_size, num_messages)
+            encoded = tokenizer([sequences.message(i) for i in range(start, end)], return_tensors='np',
+                                max_length=max_content_len, padding='max_length', truncation=True)
+            token_ids[start:end] = encoded['input_ids']
+            lengths[start:end] = encoded['attention_mask'].sum(axis=1)
+        token_ids.flush()
+        lengths.flush()
+        cls._write_text(directory, 'pad_token_id', str(tokenizer.pad_token_id))
+        return cls(directory)
+
+    def gather(self, message_ids):
+        '''
+        :return: BERT inputs of the messages, padded to the longest one, as the tokenizer would return them.
+        '''
+        lengths = self.lengths[message_ids]
+        width = int(lengths.max()) if len(lengths) > 0 else 0
+        input_ids = self.token_ids[message_ids, :width]
+        attention_mask = np.arange(width)[None, :] < lengths[:, None]
+        return BatchEncoding({
+            'input_ids': torch.from_numpy(input_ids.astype(np.int64)),
+            'token_type_ids': torch.zeros(input_ids.shape, dtype=torch.long),
+            'attention_mask': torch.from_numpy(attention_mask.astype(np.int64)),
+        })
+
+
+class EmbeddingTable(NpyDirectory):
+    '''
+    Vector of every message of a TokenStore, computed once while BERT is frozen and kept in a .npy memmap
+    `embeddings` [number of messages, dim] indexed by message id (see NpyDirectory). Used by
+    CustomCollator(embedding_table=...): the batches carry the vectors and LogLLM.train_helper skips the BERT forward.
+    `kind` is 'projected' for BERT + projector outputs (the projector must be frozen too, phase 1 of train.py),
+    stored as float16 like the Llama inputs, or 'pooler' for the BERT pooler outputs, which the projector is applied
+    to (phase 2-1, projector-only training); these are stored without rounding, as float16 if BERT computes in
+    float16 (CUDA) and as float32 otherwise.
+    '''
+    files = ('embeddings',)
+    kinds = ('projected', 'pooler')
+
+    def __init__(self, directory):
+        super().__init__(directory)
+        self.kind = self._read_text('kind')
+
+    @classmethod
+    def build(cls, token_store, encode, directory, batch_size=256, kind='projected'):
+        '''
+        :param token_store: TokenStore of the messages.
+        :param encode: function from BERT inputs (TokenStore.gather) to vectors, e.g. LogLLM.encode_messages.
+        :param directory: where the .npy file is written.
+        :param kind: what `encode` returns, see the class docstring.
+        '''
+        if kind not in cls.kinds:
+            raise ValueError(f"'kind' should be one of {cls.kinds}, got {kind!r}.")
+        # messages of similar length in the same batch, for little padding
+        order = np.argsort(np.asarray(token_store.lengths), kind='stable')
+        embeddings = None
+        for start in range(0, len(order), batch_size):
+            message_ids = order[start:start + batch_size]
+            values = encode(token_store.gather(message_ids))
+            if embeddings is None:
+                dtype = np.float16 if kind == 'projected' or values.dtype == torch.float16 else np.float32
+                embeddings = cls._open_memmap(directory, 'embeddings', dtype, (len(order), values.shape[1]))
+            values = values.float().cpu().numpy()
+            embeddings[message_ids] = values
+        if embeddings is None:
+            cls._save(directory, {'embeddings': np.zeros((0, 0), dtype=np.float16)})
+        else:
+            embeddings.flush()
+        cls._write_text(directory, 'kind', kind)
+        return cls(directory)
+
+    def gather(self, message_ids):
+        '''
+        :return: tensor [len(message_ids), dim] for 'projected', BatchEncoding with this tensor as
+                 'pooler_output' for 'pooler'.
+        '''
+        embeddings = torch.from_numpy(np.asarray(self.embeddings[message_ids]))
+        if self.kind == 'pooler':
+            return BatchEncoding({'pooler_output': embeddings})
+        return embeddings
+
+
 class CustomDataset(Dataset):
-    def __init__(self, file_path, drop_duplicates=False):
+    def __init__(self, file_path, drop_duplicates=False, normalize_workers=None, storage_dir=None):
+        '''
+        :param normalize_workers: number of processes normalizing the messages, os.cpu_count() if None.
+        :param file_path: train.csv/test.csv, or a window table <split>_windows.arrow written by
+                          prepareData.helper.write_window_tables, read memory-mapped with its message table.
+        :param storage_dir: if set, the sequences are kept as EncodedSequences memmaps written to this directory
+                            instead of an object array of lists, which takes far less memory and is shared by
+                            the DataLoader workers.
+        '''
+        if file_path.endswith('.arrow'):
+            self._load_window_tables(file_path, drop_duplicates, normalize_workers, storage_dir)
+            return
         df = pd.read_csv(file_path)
         print('Number of normal samples in original dataset: {}'.format((df['Label'].values==0).sum()))
         print('Number of anomalous samples in original dataset: {}'.format((df['Label'].values==1).sum()))
-        df['Content'] = df['Content'].apply(replace_patterns)
+        df['Content'] = normalize_windows(df['Content'].values, num_workers=normalize_workers)
         if drop_duplicates:
             df = df.drop_duplicates(subset='Content', keep='first')
         contents = df['Content'].values
-        self.sequences = np.array([content.split(' ;-; ') for content in contents], dtype=object)
+        if storage_dir is not None:
+            self.sequences = EncodedSequences.build([content.split(' ;-; ') for content in contents], storage_dir)
+        else:
+            self.sequences = np.array([content.split(' ;-; ') for content in contents], dtype=object)
+        # __getitem__ returns the message ids of the EncodedSequences instead of the messages,
+        # for CustomCollator(token_store=...)
+        self.return_message_ids = False
         self.labels = df['Label'].values
         if drop_duplicates:
             print('Number of normal samples after dropping duplicates: {}'.format((self.labels==0).sum()))
             print('Number of anomalous samples after dropping duplicates: {}'.format((self.labels==1).sum()))
 
+    def _load_window_tables(self, windows_path, drop_duplicates, normalize_workers, storage_dir):
+        unique_messages, message_ids, sequence_offsets, labels = load_window_tables(windows_path, normalize_workers)
+        print('Number of normal samples in original dataset: {}'.format((labels==0).sum()))
+        print('Number of anomalous samples in original dataset: {}'.format((labels==1).sum()))
+        if drop_duplicates:
+            keys = [message_ids[start:end].tobytes() for start, end in zip(sequence_offsets[:-1], sequence_offsets[1:])]
+            keep = ~pd.Series(keys).duplicated(keep='first').values
+            lengths = np.diff(sequence_offsets)
+            message_ids = message_ids[np.repeat(keep, lengths)]
+            sequence_offsets = np.concatenate([[0], np.cumsum(lengths[keep])])
+            labels = labels[keep]
+
+        if storage_dir is not None:
+            self.sequences = EncodedSequences.write(unique_messages, message_ids, sequence_offsets, storage_dir)
+        else:
+            self.sequences = np.empty(len(labels), dtype=object)
+            for i, (start, end) in enumerate(zip(sequence_offsets[:-1], sequence_offsets[1:])):
+                self.sequences[i] = [unique_messages[message_id] for message_id in message_ids[start:end]]
+        self.return_message_ids = False
+        self.labels = labels
+        if drop_duplicates:
+            print('Number of normal samples after dropping duplicates: {}'.format((self.labels==0).sum()))
+            print('Number of anomalous samples after dropping duplicates: {}'.format((self.labels==1).sum()))
+
     def __len__(self):
         return len(self.labels)
 
     def __getitem__(self, idx):
+        if self.return_message_ids:
+            return np.asarray(self.sequences.sequence_ids(idx)), self.labels[idx]
         return self.sequences[idx], self.labels[idx]
 
     def get_label(self):
         return self.labels
 
+    def get_lengths(self):
+        '''
+        :return: number of messages of each sequence, and the number of words of its longest message.
+        '''
+        if isinstance(self.sequences, EncodedSequences):
+            return self.sequences.get_lengths()
+        seq_lengths = np.array([len(seq) for seq in self.sequences])
+        token_lengths = np.array([max((len(message.split()) for message in seq), default=0) for seq in self.sequences])
+        return seq_lengths, token_lengths
+
 def merge_data(data):
     merged_data = []
 
@@ -88,16 +458,40 @@ def merge_data(data):
     return merged_data, start_positions
 
 
+def balanced_epoch_size(num_minority, num_majority, target_ratio, max_samples=None, min_samples=50000):
+    '''
+    Epoch size of BalancedSampler: the minority class is oversampled to `target_ratio` of the windows (never below
+    its own size), then the epoch is cut to `max_samples`, or extended to `min_samples` if max_samples is None.
+    :return: (number of minority draws before the cut/extension, number of draws of the epoch)
+    '''
+    minority_count = max(int((target_ratio * num_majority) / (1 - target_ratio)), num_minority)
+    total_size = minority_count + num_majority
+
+    if max_samples is not None:
+        if max_samples > total_size:
+            raise ValueError(
+        f"The hyperparameter 'max_samples' should smaller than the samples in the dataset.")
+        total_size = max_samples
+
+    elif total_size < min_samples:
+        total_size = min_samples
+    return minority_count, total_size
+
+
 class BalancedSampler(Sampler):
-    def __init__(self, dataset, target_ratio=0.3, max_samples=None, min_samples=50000):
+    def __init__(self, dataset, target_ratio=0.3, max_samples=None, min_samples=50000, indices=None):
+        '''
+        :param indices: sorted dataset indices to sample from (e.g. without a held-out split), all of them if None.
+        '''
         self.labels = dataset.get_label()
         self.dataset = dataset
         self.target_ratio = target_ratio
         self.max_samples = max_samples
         self.min_samples = min_samples  # only if max_samples is None, min_samples can work
 
-        self.normal_indices = np.where(self.labels == 0)[0]
-        self.anomalous_indices = np.where(self.labels == 1)[0]
+        indices = np.arange(len(self.labels)) if indices is None else np.asarray(indices)
+        self.normal_indices = indices[self.labels[indices] == 0]
+        self.anomalous_indices = indices[self.labels[indices] == 1]
 
         self.minority_indices = (
             self.anomalous_indices if len(self.anomalous_indices) < len(self.normal_indices)
@@ -108,17 +502,9 @@ class BalancedSampler(Sampler):
             else self.anomalous_indices
         )
 
-        self.minority_count = max(int((self.target_ratio * len(self.majority_indices)) / (1 - self.target_ratio)), len(self.minority_indices))
-        self.total_size = self.minority_count + len(self.majority_indices)
-
-        if self.max_samples is not None:
-            if self.max_samples > self.total_size:
-                raise ValueError(
-            f"The hyperparameter 'max_samples' should smaller than the samples in the dataset.")
-            self.total_size = self.max_samples
-
-        elif self.total_size < self.min_samples:
-            self.total_size = self.min_samples
+        self.minority_count, self.total_size = balanced_epoch_size(
+            len(self.minority_indices), len(self.majority_indices), self.target_ratio, self.max_samples,
+            self.min_samples)
 
 
     def __iter__(self):
@@ -150,13 +536,246 @@ class BalancedSampler(Sampler):
         return self.total_size
 
 
+def iter_window_chunks(file_path, chunk_size=100000):
+    '''
+    Read train.csv/test.csv, or a window table written by prepareData.helper.write_window_tables (with its
+    memory-mapped message table), `chunk_size` windows at a time.
+    :return: iterator of (windows of messages joined by ' ;-; ', labels)
+    '''
+    if not file_path.endswith('.arrow'):
+        for chunk in pd.read_csv(file_path, chunksize=chunk_size):
+            yield chunk['Content'].tolist(), chunk['Label'].values
+        return
+
+    for messages, offsets, positions, labels in iter_window_positions(file_path, chunk_size):
+        contents = messages.take(pa.array(positions, type=pa.int64())).to_pylist()
+        yield [' ;-; '.join(contents[begin:end]) for begin, end in zip(offsets[:-1], offsets[1:])], labels
+
+
+class WindowShards:
+    '''
+    Normalized windows split into Arrow IPC shard files of `shard_size` windows (Content joined by ' ;-; ' and
+    Label), written one shard at a time, and the number of normal/anomalous windows of every shard
+    (`label_counts` [number of shards, 2]). Read by StreamingWindowDataset, one shard at a time.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        self.label_counts = np.load(os.path.join(directory, 'label_counts.npy'))
+        self.paths = [os.path.join(directory, 'shard_{:05d}.arrow'.format(i)) for i in range(len(self.label_counts))]
+
+    @classmethod
+    def build(cls, file_path, directory, shard_size=100000, normalize_workers=None):
+        '''
+        :param file_path: train.csv/test.csv or a <split>_windows.arrow window table, see iter_window_chunks.
+        :param directory: where the shards are written.
+        '''
+        os.makedirs(directory, exist_ok=True)
+        label_counts = []
+        for i, (contents, labels) in enumerate(iter_window_chunks(file_path, shard_size)):
+            labels = np.asarray(labels, dtype=np.int64)
+            table = pa.table({'Content': pa.array(normalize_windows(contents, num_workers=normalize_workers),
+                                                  type=pa.string()),
+                              'Label': pa.array(labels)})
+            with pa.OSFile(os.path.join(directory, 'shard_{:05d}.arrow'.format(i)), 'wb') as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+            label_counts.append([(labels == 0).sum(), (labels == 1).sum()])
+        np.save(os.path.join(directory, 'label_counts.npy'), np.array(label_counts, dtype=np.int64).reshape(-1, 2))
+        return cls(directory)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def read(self, shard):
+        '''
+        :return: the windows (lists of messages) and labels of a shard.
+        '''
+        table = read_arrow_table(self.paths[shard])
+        sequences = [content.split(' ;-; ') for content in table.column('Content').to_pylist()]
+        return sequences, table.column('Label').to_numpy()
+
+
+class StreamingWindowDataset(IterableDataset):
+    '''
+    Iterable over the windows of a WindowShards, for datasets too large for CustomDataset + BalancedSampler:
+    only one shard and the shuffle buffer are in memory in every DataLoader worker. Yields (messages, label) like
+    CustomDataset, for CustomCollator without token_store.
+
+    Worker i of the `num_workers` DataLoader workers reads the shards i, i + num_workers, ..., in a new random order
+    every epoch, so every shard is read by exactly one worker and the number of windows of every worker is the same
+    in every epoch. Each worker yields a multiple of `batch_size` windows (its remainder, which the DataLoader would
+    batch alone, is dropped), so len(DataLoader) is the exact number of batches of an epoch. Each window is
+    repeated (oversampling) or dropped (undersampling) so that every class is drawn as often as BalancedSampler
+    draws it in expectation with the same target_ratio, max_samples and min_samples: the number of draws of a
+    class in a shard is fixed (the rounded share of the shard in the class total), the windows that get an extra
+    draw are chosen at random in every epoch. The windows of a shard are shuffled, then go through a shuffle
+    buffer of `shuffle_buffer_size` windows that mixes consecutive shards.
+    '''
+    def __init__(self, shards, target_ratio=None, max_samples=None, min_samples=50000, shuffle_buffer_size=10000,
+                 num_workers=0, batch_size=1):
+        '''
+        :param target_ratio: as BalancedSampler, None draws every window once.
+        :param num_workers: num_workers of the DataLoader (0: loaded in the main process).
+        :param batch_size: batch_size of the DataLoader.
+        '''
+        self.shards = shards
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.num_workers = num_workers
+        self.batch_size = batch_size
+        counts = shards.label_counts
+        num_normal, num_anomalous = counts.sum(axis=0)
+        rates = np.ones(2)
+        if target_ratio is not None:
+            minority, majority = (1, 0) if num_anomalous < num_normal else (0, 1)
+            num_minority, num_majority = (num_anomalous, num_normal) if minority == 1 else (num_normal, num_anomalous)
+            minority_count, total_size = balanced_epoch_size(num_minority, num_majority, target_ratio, max_samples,
+                                                             min_samples)
+            # expected number of draws of every window of the class, as in BalancedSampler.__iter__
+            scale = total_size / (minority_count + num_majority)
+            rates[majority] = scale
+            rates[minority] = scale * minority_count / num_minority if num_minority > 0 else 0
+        # draws of every class in every shard: differences of the rounded cumulative expected draws, so that the
+        # totals are the rounded class totals
+        cumulative = np.concatenate([np.zeros((1, 2), dtype=np.int64), np.cumsum(counts, axis=0)])
+        self.draws = np.diff(np.floor(cumulative * rates + 0.5).astype(np.int64), axis=0)
+
+    def _worker_size(self, worker_id, num_workers):
+        '''
+        :return: number of windows yielded by a worker in every epoch, a multiple of batch_size.
+        '''
+        num_draws = int(self.draws[worker_id::num_workers].sum())
+        return num_draws - num_draws % self.batch_size
+
+    def __len__(self):
+        num_workers = max(self.num_workers, 1)
+        return sum(self._worker_size(worker_id, num_workers) for worker_id in range(num_workers))
+
+    def _shard_draws(self, shard, rng):
+        '''
+        :return: the windows of a shard with their drawn repetitions, shuffled.
+        '''
+        sequences, labels = self.shards.read(shard)
+        indices = []
+        for label in (0, 1):
+            class_indices = np.flatnonzero(labels == label)
+            num_draws = self.draws[shard, label]
+            if len(class_indices) == 0 or num_draws == 0:
+                continue
+            repeats = np.full(len(class_indices), num_draws // len(class_indices))
+            repeats[rng.choice(len(class_indices), num_draws % len(class_indices), replace=False)] += 1
+            indices.append(np.repeat(class_indices, repeats))
+        indices = np.concatenate(indices) if indices else np.array([], dtype=np.int64)
+        rng.shuffle(indices)
+        return [(sequences[i], labels[i]) for i in indices]
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        if worker_info is None:
+            worker_id, num_workers, seed = 0, 1, np.random.randint(2 ** 31)
+        else:
+            # the DataLoader draws a new base seed for every epoch, worker i gets base seed + i
+            worker_id, num_workers, seed = worker_info.id, worker_info.num_workers, worker_info.seed
+        if num_workers != max(self.num_workers, 1):
+            raise ValueError(f'StreamingWindowDataset was created for num_workers={self.num_workers}, '
+                             f'but is loaded by {num_workers} worker(s).')
+        rng = np.random.default_rng(seed % 2 ** 32)
+        shards = np.arange(worker_id, len(self.shards), num_workers)
+        yield from islice(self._iter_worker(rng.permutation(shards), rng), self._worker_size(worker_id, num_workers))
+
+    def _iter_worker(self, shards, rng):
+        buffer = []
+        for shard in shards:
+            for sample in self._shard_draws(shard, rng):
+                if len(buffer) < self.shuffle_buffer_size:
+                    buffer.append(sample)
+                    continue
+                i = rng.integers(len(buffer))
+                yield buffer[i]
+                buffer[i] = sample
+        rng.shuffle(buffer)
+        yield from buffer
+
+
+class LengthBucketBatchSampler(Sampler):
+    '''
+    Batch sampler that puts sequences of similar length (number of messages, then length of the longest message)
+    into the same batch, so that little padding is needed for Llama and BERT.
+
+    Without `sampler`, every index is visited once in length order, the order of the last iteration is kept in
+    `last_order` (see restore_order).
+    With `sampler` (e.g. BalancedSampler), its indices are taken `batch_size * bucket_size_multiplier` at a time,
+    sorted by length inside the bucket and cut into batches, and the batches are shuffled. The indices drawn, hence
+    the class balance targeted by the sampler, do not change.
+    '''
+    def __init__(self, dataset, batch_size, sampler=None, bucket_size_multiplier=50, max_seq_len=None,
+                 drop_last=False):
+        self.batch_size = batch_size
+        self.sampler = sampler
+        self.bucket_size = batch_size * bucket_size_multiplier
+        self.drop_last = drop_last
+        self.last_order = None
+
+        seq_lengths, token_lengths = dataset.get_lengths()
+        if max_seq_len is not None:
+            seq_lengths = np.minimum(seq_lengths, max_seq_len)
+        # rank of every index in length order
+        self.length_rank = np.empty(len(seq_lengths), dtype=np.int64)
+        self.length_rank[np.lexsort((token_lengths, seq_lengths))] = np.arange(len(seq_lengths))
+
+    def _batches(self, indices):
+        batches = [indices[i:i + self.batch_size] for i in range(0, len(indices), self.batch_size)]
+        if self.drop_last and len(batches) > 0 and len(batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+        return batches
+
+    def __iter__(self):
+        if self.sampler is None:
+            batches = self._batches(np.argsort(self.length_rank))
+        else:
+            indices = np.fromiter(iter(self.sampler), dtype=np.int64)
+            batches = []
+            for start in range(0, len(indices), self.bucket_size):
+                bucket = indices[start:start + self.bucket_size]
+                batches.extend(self._batches(bucket[np.argsort(self.length_rank[bucket], kind='stable')]))
+            np.random.shuffle(batches)
+        self.last_order = np.concatenate(batches) if batches else np.array([], dtype=np.int64)
+        return iter([batch.tolist() for batch in batches])
+
+    def __len__(self):
+        num_samples = len(self.length_rank) if self.sampler is None else len(self.sampler)
+        if self.drop_last:
+            return num_samples // self.batch_size
+        return (num_samples + self.batch_size - 1) // self.batch_size
+
+
+def restore_order(values, order):
+    '''
+    Put per-sample results produced in the visiting order of a LengthBucketBatchSampler back into dataset order.
+    '''
+    values = np.asarray(values)
+    restored = np.empty_like(values)
+    restored[order] = values
+    return restored
+
+
 class CustomCollator:
-    def __init__(self, tokenizer, max_seq_len=128, max_content_len=100):
+    def __init__(self, tokenizer, max_seq_len=128, max_content_len=100, deduplicate=False, token_store=None,
+                 embedding_table=None):
         self.tokenizer = tokenizer
         self.max_seq_len = max_seq_len
         self.max_content_len = max_content_len
+        # only tokenize the unique messages of a batch, and return "inverse_indices" to restore the full order
+        self.deduplicate = deduplicate
+        # TokenStore of the dataset: the samples are message ids (CustomDataset.return_message_ids) and the
+        # pre-tokenized rows are gathered instead of calling the tokenizer
+        self.token_store = token_store
+        # EmbeddingTable of the dataset: "inputs" are the precomputed message embeddings (or BERT pooler outputs)
+        # instead of BERT inputs, while BERT (and the projector) are frozen
+        self.embedding_table = embedding_table
 
     def __call__(self, batch):
+        if self.token_store is not None or self.embedding_table is not None:
+            return self._collate_message_ids(batch)
         sequences_, labels = zip(*batch)
 
         # 截断每个子序列的长度
@@ -165,6 +784,11 @@ class CustomCollator:
         data, seq_positions = merge_data(sequences)
         seq_positions = seq_positions[1:]  # 去掉第一个0位置，用于后续分界处理
 
+        if self.deduplicate:
+            unique_index = {}
+            inverse_indices = [unique_index.setdefault(message, len(unique_index)) for message in data]
+            data = list(unique_index)
+
         # 将合并后的 data 编码
         inputs = self.tokenizer(
             data,
@@ -174,6 +798,33 @@ class CustomCollator:
             truncation=True
         )
 
+        return self._make_batch(inputs, seq_positions, labels, inverse_indices if self.deduplicate else None)
+
+    def _collate_message_ids(self, batch):
+        sequences, labels = zip(*batch)
+        sequences = [seq[:self.max_seq_len] for seq in sequences]
+        seq_positions = np.cumsum([len(seq) for seq in sequences])[:-1]
+        message_ids = np.concatenate(sequences)
+
+        inverse_indices = None
+        if self.deduplicate:
+            # unique messages in order of first appearance, as in __call__
+            unique_ids, first_positions, inverse_indices = np.unique(message_ids, return_index=True,
+                                                                     return_inverse=True)
+            order = np.argsort(first_positions)
+            rank = np.empty_like(order)
+            rank[order] = np.arange(len(order))
+            message_ids = unique_ids[order]
+            inverse_indices = rank[inverse_indices]
+
+        if self.embedding_table is not None:
+            inputs = self.embedding_table.gather(message_ids)
+        else:
+            inputs = self.token_store.gather(message_ids)
+        return self._make_batch(inputs, seq_positions, labels, inverse_indices)
+
+    @staticmethod
+    def _make_batch(inputs, seq_positions, labels, inverse_indices):
         # 构建 label tensor
         # labels_tensor = torch.tensor(labels, dtype=torch.long)
 
@@ -182,9 +833,12 @@ class CustomCollator:
         labels[labels == 0] = 'normal'
         labels[labels == 1] = 'anomalous'
 
-        return {
+        batch = {
             "inputs": inputs,
             "seq_positions": torch.tensor(seq_positions, dtype=torch.long),
             # "labels": labels_tensor
             "labels": labels
         }
+        if inverse_indices is not None:
+            batch["inverse_indices"] = torch.as_tensor(inverse_indices, dtype=torch.long)
+        return batch
@@ -6,28 +6,42 @@ import torch
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 from model import LogLLM
-from customDataset import CustomDataset, CustomCollator
+from customDataset import CustomDataset, CustomCollator, LengthBucketBatchSampler, TokenStore, restore_order
 from sklearn.metrics import accuracy_score, precision_score, recall_score, f1_score
 
 max_content_len = 100
 max_seq_len = 128
 batch_size = 32
+score_mode = True   # single-pass logit scoring instead of greedy decoding
+anomaly_threshold = 0.5
+embedding_cache_size = 50000   # LRU cache of projected message embeddings (0 disables it), hit rate printed at the end
+bucket_by_length = True   # batch sequences of similar length together to reduce padding
 dataset_name = 'Liberty'   # 'Thunderbird' 'HDFS_v1'  'BGL'  'Liberty‘
 data_path = r'/mnt/public/gw/SyslogData/{}/test.csv'.format(dataset_name)
+# data_path = r'/mnt/public/gw/SyslogData/{}/test_windows.arrow'.format(dataset_name)   # prepareData output_format = 'arrow'
 
 Bert_path = r"/hy-tmp/model_weights/AI-ModelScope/bert-base-uncased"
 Llama_path = r"/hy-tmp/model_weights/LLM-Research/Meta-Llama-3-8B"
 
 ROOT_DIR = Path(__file__).parent
 ft_path = os.path.join(ROOT_DIR, r"ft_model_{}".format(dataset_name))
+# memmap storage of the sequences shared by the DataLoader workers (None keeps them as Python lists)
+storage_dir = os.path.join(ROOT_DIR, r"cache_{}".format(dataset_name), 'test_sequences')
+pretokenize = True   # tokenize every unique message once into a TokenStore in storage_dir (requires storage_dir)
 
-device = torch.device("cuda:0")
+device = torch.device(os.environ.get('LOGLLM_DEVICE', 'cuda:0'))   # 'cpu' runs without bitsandbytes/CUDA
+cpu_int8 = False   # CPU only: merge LoRA and use dynamic int8 quantization of the Linear layers
+num_threads = None   # CPU only: number of intra-op threads
+merge_adapters = False   # merge the LoRA adapters into unquantized (float16 on CUDA) base weights before inference
+merged_save_path = None   # e.g. os.path.join(ROOT_DIR, 'merged_model_{}'.format(dataset_name)), reusable as ft_path
 
 print(
 f'dataset_name: {dataset_name}\n'
 f'batch_size: {batch_size}\n'
 f'max_content_len: {max_content_len}\n'
 f'max_seq_len: {max_seq_len}\n'
+f'score_mode: {score_mode}\n'
+f'merge_adapters: {merge_adapters}\n'
 f'device: {device}')
 
 
@@ -44,7 +58,12 @@ def evalModel(model, dataloader):
             inputs = inputs.to(device)
             seq_positions = seq_positions
 
-            outputs_ids = model(inputs,seq_positions)
+            if score_mode:
+                probs = model.score(inputs, seq_positions, inverse_indices=bathc_i.get('inverse_indices'))
+                preds.extend(np.where(probs.cpu().numpy() >= anomaly_threshold, 'anomalous', 'normal'))
+                continue
+
+            outputs_ids = model(inputs,seq_positions, inverse_indices=bathc_i.get('inverse_indices'))
             outputs = model.Llama_tokenizer.batch_decode(outputs_ids)
 
             # print(outputs)
@@ -57,6 +76,9 @@ def evalModel(model, dataloader):
                     print(f'error :{text}')
                     preds.append('')
 
+    if isinstance(dataloader.batch_sampler, LengthBucketBatchSampler):
+        preds = restore_order(preds, dataloader.batch_sampler.last_order)
+
     preds_copy = np.array(preds)
     preds = np.zeros_like(preds_copy,dtype=int)
     preds[preds_copy == 'anomalous'] = 1
@@ -81,22 +103,43 @@ def evalModel(model, dataloader):
 
     print(f'precision: {precision}, recall: {recall}, f1: {f}, acc: {acc}')
 
+    if model.embedding_cache is not None:
+        stats = model.embedding_cache.stats()
+        print(f"embedding cache: hit rate {stats['hit_rate']:.4f} ({stats['hits']} hits, {stats['misses']} misses, "
+              f"{stats['evictions']} evictions, {stats['size']}/{stats['capacity']} entries)")
+
 
 if __name__ == '__main__':
     print(f'dataset: {data_path}')
-    dataset = CustomDataset(data_path)
+    dataset = CustomDataset(data_path, storage_dir=storage_dir)
     model = LogLLM(Bert_path, Llama_path, ft_path=ft_path, is_train_mode=False, device=device,
-                   max_content_len=max_content_len, max_seq_len=max_seq_len)
+                   max_content_len=max_content_len, max_seq_len=max_seq_len, embedding_cache_size=embedding_cache_size,
+                   cpu_int8=cpu_int8, num_threads=num_threads,
+                   merge_adapters=merge_adapters, merged_save_path=merged_save_path)
 
     tokenizer = model.Bert_tokenizer
-    collator = CustomCollator(tokenizer, max_seq_len=max_seq_len, max_content_len=max_content_len)
-    dataloader = DataLoader(
-        dataset,
-        batch_size=batch_size,
-        collate_fn=collator,
-        num_workers=4,
-        shuffle=False,
-        drop_last=False
-    )
+    token_store = None
+    if pretokenize and storage_dir is not None:
+        token_store = TokenStore.build(dataset.sequences, tokenizer, max_content_len,
+                                       os.path.join(storage_dir, 'bert_tokens'))
+        dataset.return_message_ids = True
+    collator = CustomCollator(tokenizer, max_seq_len=max_seq_len, max_content_len=max_content_len, deduplicate=True,
+                              token_store=token_store)
+    if bucket_by_length:
+        dataloader = DataLoader(
+            dataset,
+            batch_sampler=LengthBucketBatchSampler(dataset, batch_size, max_seq_len=max_seq_len),
+            collate_fn=collator,
+            num_workers=4,
+        )
+    else:
+        dataloader = DataLoader(
+            dataset,
+            batch_size=batch_size,
+            collate_fn=collator,
+            num_workers=4,
+            shuffle=False,
+            drop_last=False
+        )
 
     evalModel(model, dataloader)
\ No newline at end of file
@@ -28,7 +28,7 @@ batch_size = 32
 Bert_path = r"/hy-tmp/model_weights/AI-ModelScope/bert-base-uncased"
 Llama_path = r"/hy-tmp/model_weights/LLM-Research/Meta-Llama-3-8B"
 ROOT_DIR = Path(__file__).parent.parent
-device = torch.device("cuda:0")
+device = torch.device(os.environ.get('LOGLLM_DEVICE', 'cuda:0'))   # 'cpu' runs without bitsandbytes/CUDA
 
 def evalModel(model, dataloader, dataset_name):
     """评估函数"""
@@ -29,7 +29,7 @@ Llama_path = r"/hy-tmp/model_weights/LLM-Research/Meta-Llama-3-8B"
 ROOT_DIR = Path(__file__).parent.parent
 ft_path = os.path.join(ROOT_DIR, r"ft_model_Liberty")
 
-device = torch.device("cuda:0")
+device = torch.device(os.environ.get('LOGLLM_DEVICE', 'cuda:0'))   # 'cpu' runs without bitsandbytes/CUDA
 
 print("=" * 60)
 print(f"评估数据集: {dataset_name}")
@@ -1,4 +1,7 @@
+import json
 import os.path
+from collections import OrderedDict
+from itertools import chain
 
 import peft
 import torch
@@ -76,6 +79,260 @@ def stack_and_pad_left(tensors):
 
     return stacked_tensor, padding_masks
 
+def first_diverging_token_ids(tokenizer, prefix, answers):
+    '''
+    Find, for each answer, the first token after `prefix` at which the tokenized answers differ.
+    :param tokenizer: the Llama tokenizer.
+    :param prefix: text shared by all answers, e.g. "The sequence is".
+    :param answers: continuations of the prefix, e.g. [' normal.', ' anomalous.'].
+    :return: list of token ids, one per answer.
+    '''
+    prefix_ids = tokenizer(prefix)['input_ids']
+    answer_ids = [tokenizer(prefix + answer)['input_ids'] for answer in answers]
+    for ids in answer_ids:
+        if ids[:len(prefix_ids)] != prefix_ids:
+            raise ValueError(f'Tokenization of "{prefix}" is not a prefix of the tokenized answers.')
+    position = len(prefix_ids)
+    first_ids = [ids[position] if position < len(ids) else None for ids in answer_ids]
+    if None in first_ids or len(set(first_ids)) < len(first_ids):
+        raise ValueError('The answers must differ at the first token after the prefix.')
+    return first_ids
+
+class EmbeddingLRUCache:
+    '''
+    Bounded LRU cache from a log message (the bytes of its BERT token ids) to its projected embedding.
+    Embeddings are kept in one preallocated [capacity, dim] table, so a batch is gathered with a single index.
+    '''
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.slots = OrderedDict()  # key -> row of self.table, least recently used first
+        self.table = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.slots)
+
+    def lookup(self, keys):
+        '''
+        :return: list with the table row of every key, -1 for misses.
+        '''
+        rows = []
+        for key in keys:
+            row = self.slots.get(key, -1)
+            if row >= 0:
+                self.slots.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+            rows.append(row)
+        return rows
+
+    def insert(self, keys, values):
+        if self.table is None:
+            self.table = torch.empty((self.capacity, values.shape[-1]), dtype=values.dtype, device=values.device)
+        rows = []
+        for key in keys[-self.capacity:]:
+            if key in self.slots:
+                row = self.slots.pop(key)
+            elif len(self.slots) < self.capacity:
+                row = len(self.slots)
+            else:
+                _, row = self.slots.popitem(last=False)
+                self.evictions += 1
+            self.slots[key] = row
+            rows.append(row)
+        self.table[torch.tensor(rows, device=self.table.device)] = values[-self.capacity:]
+
+    def clear(self):
+        self.slots.clear()
+        self.table = None
+
+    def stats(self):
+        '''
+        :return: counters since creation; many evictions with a low hit rate mean the capacity is too small.
+        '''
+        return {'size': len(self.slots), 'capacity': self.capacity, 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'hit_rate': self.hits / max(self.hits + self.misses, 1)}
+
+
+def message_keys(inputs):
+    '''
+    Content-addressed keys of the tokenized messages: the bytes of the unpadded BERT input ids of each row.
+    '''
+    input_ids = inputs['input_ids'].cpu().numpy()
+    lengths = inputs['attention_mask'].sum(dim=1).cpu().numpy()
+    return [row[:length].tobytes() for row, length in zip(input_ids, lengths)]
+
+
+def select_rows(inputs, rows):
+    '''
+    Select some messages from the tokenized BERT inputs and drop the padding columns that become unnecessary.
+    '''
+    max_len = int(inputs['attention_mask'][rows].sum(dim=1).max())
+    return {key: value[rows, :max_len] for key, value in inputs.items()}
+
+def pad_token_lists(token_lists, pad_id, device):
+    '''
+    :return: LongTensor [len(token_lists), max length] right-padded with pad_id, and the length of every list.
+    '''
+    lengths = torch.tensor([len(ids) for ids in token_lists], dtype=torch.long, device=device)
+    padded = torch.full((len(token_lists), int(lengths.max())), pad_id, dtype=torch.long, device=device)
+    for i, ids in enumerate(token_lists):
+        padded[i, :len(ids)] = torch.tensor(ids, dtype=torch.long, device=device)
+    return padded, lengths
+
+
+class PromptBuilder:
+    '''
+    Assembles the prompts [ins1][padding][log sequence][ins2][answer] of a batch directly into one buffer.
+    The constant pieces are tokenized once, embedded once, and the message and token embeddings of the whole batch
+    are written into the buffer with a single scatter at precomputed offsets.
+
+    The part after the log sequence is a "tail": one per label for training (ins2 + "The sequence is <label>."),
+    and one for inference (ins2 + "The sequence is"), selected per row by tail index.
+    '''
+    def __init__(self, tokenizer, instructions, answer_prefix, labels, device):
+        def token_ids(text, drop_bos):
+            ids = tokenizer(text)['input_ids']
+            return ids[1:] if drop_bos else ids
+
+        self.labels = list(labels)
+        self.ins1_ids = torch.tensor(token_ids(instructions[0], False), dtype=torch.long, device=device)
+        ins2_ids = token_ids(instructions[1], True)
+        answer_ids = [token_ids(f'{answer_prefix} {label}.', True) for label in self.labels]
+
+        self.inference_tail = len(self.labels)
+        self.tail_ids, self.tail_lens = pad_token_lists([ins2_ids + ids for ids in answer_ids]
+                                                        + [ins2_ids + token_ids(answer_prefix, True)],
+                                                        tokenizer.pad_token_id, device)
+        self.answer_lens = torch.tensor([len(ids) for ids in answer_ids] + [0], dtype=torch.long, device=device)
+        # training targets: the answer followed by eos
+        self.target_ids, self.target_lens = pad_token_lists([ids + [tokenizer.eos_token_id] for ids in answer_ids],
+                                                            tokenizer.pad_token_id, device)
+        self.ins1_embeds = None
+        self.tail_embeds = None
+
+    @property
+    def prefix_len(self):
+        return self.ins1_ids.shape[0]
+
+    def reset(self):
+        self.ins1_embeds = None
+        self.tail_embeds = None
+
+    def embed(self, embed_tokens):
+        if self.ins1_embeds is None:
+            with torch.no_grad():
+                self.ins1_embeds = embed_tokens(self.ins1_ids)
+                self.tail_embeds = embed_tokens(self.tail_ids)
+
+    def label_index(self, labels):
+        '''
+        :param labels: np.array of label strings, as produced by CustomCollator.
+        :return: tail index of every row.
+        '''
+        labels = np.asarray(labels)
+        index = np.full(len(labels), -1, dtype=np.int64)
+        for i, label in enumerate(self.labels):
+            index[labels == label] = i
+        if (index < 0).any():
+            unknown = sorted(set(labels[index < 0].tolist()))
+            raise ValueError(f'Unknown labels {unknown}, expected one of {self.labels}.')
+        return torch.from_numpy(index).to(self.tail_ids.device)
+
+    def build(self, message_embeddings, seq_lengths, tail_index, include_prefix=True):
+        '''
+        :param message_embeddings: [number of messages, hidden size], the messages of all sequences concatenated.
+        :param seq_lengths: number of messages of every sequence.
+        :param tail_index: tail of every sequence, see label_index() and inference_tail.
+        :param include_prefix: write ins1 in front; without it, the KV of ins1 must come from a prefix cache.
+        :return: inputs_embeds, attention_mask (covering the prefix in any case) and position_ids.
+        '''
+        device = message_embeddings.device
+        batch_size = seq_lengths.shape[0]
+        hidden_size = message_embeddings.shape[-1]
+        prefix_len = self.prefix_len
+        offset = prefix_len if include_prefix else 0
+
+        tail_lens = self.tail_lens[tail_index]
+        suffix_lens = seq_lengths + tail_lens
+        suffix_max = int(suffix_lens.max())
+        starts = offset + suffix_max - suffix_lens  # column of the first message of every sequence
+
+        rows = torch.arange(batch_size, device=device)
+        message_rows = torch.repeat_interleave(rows, seq_lengths)
+        message_cols = (starts - (torch.cumsum(seq_lengths, 0) - seq_lengths))[message_rows] + \
+            torch.arange(message_embeddings.shape[0], device=device)
+        tail_rows, tail_pos = (torch.arange(self.tail_ids.shape[1], device=device)[None, :]
+                               < tail_lens[:, None]).nonzero(as_tuple=True)
+        tail_cols = (starts + seq_lengths)[tail_rows] + tail_pos
+        tail_values = self.tail_embeds[tail_index[tail_rows], tail_pos].to(message_embeddings.dtype)
+
+        inputs_embeds = message_embeddings.new_zeros((batch_size, offset + suffix_max, hidden_size))
+        if include_prefix:
+            inputs_embeds[:, :prefix_len] = self.ins1_embeds.to(message_embeddings.dtype)
+        inputs_embeds = inputs_embeds.index_put((torch.cat([message_rows, tail_rows]), torch.cat([message_cols, tail_cols])),
+                                                torch.cat([message_embeddings, tail_values]))
+
+        columns = torch.arange(prefix_len + suffix_max, device=device)[None, :]
+        attention_mask = ((columns < prefix_len) | (columns >= prefix_len + suffix_max - suffix_lens[:, None])).long()
+        position_ids = (attention_mask.cumsum(dim=1) - 1).clamp(min=0)[:, -inputs_embeds.shape[1]:]
+        return inputs_embeds, attention_mask, position_ids
+
+    def build_packed(self, message_embeddings, seq_lengths, tail_index):
+        '''
+        Concatenate the prompts [ins1][log sequence][tail] of the batch into a single row, without padding.
+        :return: inputs_embeds [1, total length, hidden size], position_ids restarting at 0 for every prompt,
+                 the prompt index of every column, and the mask of the columns whose logits predict the answer.
+        '''
+        device = message_embeddings.device
+        batch_size = seq_lengths.shape[0]
+        prefix_len = self.prefix_len
+        tail_lens = self.tail_lens[tail_index]
+        prompt_lens = prefix_len + seq_lengths + tail_lens
+        prompt_starts = torch.cumsum(prompt_lens, 0) - prompt_lens
+        total_len = int(prompt_lens.sum())
+
+        rows = torch.arange(batch_size, device=device)
+        prefix_rows = rows.repeat_interleave(prefix_len)
+        prefix_pos = torch.arange(prefix_len, device=device).repeat(batch_size)
+        message_rows = torch.repeat_interleave(rows, seq_lengths)
+        message_cols = (prompt_starts + prefix_len - (torch.cumsum(seq_lengths, 0) - seq_lengths))[message_rows] + \
+            torch.arange(message_embeddings.shape[0], device=device)
+        tail_rows, tail_pos = (torch.arange(self.tail_ids.shape[1], device=device)[None, :]
+                               < tail_lens[:, None]).nonzero(as_tuple=True)
+        tail_cols = (prompt_starts + prefix_len + seq_lengths)[tail_rows] + tail_pos
+
+        inputs_embeds = message_embeddings.new_zeros((total_len, message_embeddings.shape[-1]))
+        inputs_embeds = inputs_embeds.index_put(
+            (torch.cat([prompt_starts[prefix_rows] + prefix_pos, message_cols, tail_cols]),),
+            torch.cat([self.ins1_embeds[prefix_pos].to(message_embeddings.dtype), message_embeddings,
+                       self.tail_embeds[tail_index[tail_rows], tail_pos].to(message_embeddings.dtype)]))
+
+        segment_ids = torch.repeat_interleave(rows, prompt_lens)
+        position_ids = torch.arange(total_len, device=device) - prompt_starts[segment_ids]
+        label_mask = position_ids >= (prompt_lens - self.answer_lens[tail_index] - 1)[segment_ids]
+        return inputs_embeds[None], position_ids[None], segment_ids, label_mask[None]
+
+    def answer_masks(self, tail_index, width):
+        '''
+        :return: mask of the columns (of a buffer `width` wide) whose logits predict the answer and eos,
+                 and the target token ids at those columns, flattened in row order.
+        '''
+        label_mask = torch.arange(width, device=tail_index.device)[None, :] >= \
+            width - self.answer_lens[tail_index][:, None] - 1
+        return label_mask, self.targets(tail_index)
+
+    def targets(self, tail_index):
+        '''
+        :return: the answer and eos token ids of every row, flattened in row order.
+        '''
+        target_lens = self.target_lens[tail_index]
+        target_mask = torch.arange(self.target_ids.shape[1], device=tail_index.device)[None, :] < target_lens[:, None]
+        return self.target_ids[tail_index][target_mask]
+
 bnb_config = BitsAndBytesConfig(
     load_in_4bit=True,  # load the model into memory using 4-bit precision
     bnb_4bit_use_double_quant=False,  # use double quantition
@@ -83,51 +340,196 @@ bnb_config = BitsAndBytesConfig(
     bnb_4bit_compute_dtype=torch.bfloat16  # use hf for computing when we need
 )
 
+def load_merged_model(model_class, base_path, adapter_path, quantization_config, torch_dtype, device, save_path=None,
+                      attn_implementation=None):
+    '''
+    Load a base model with its LoRA adapter merged into the weights, as a plain (non-peft) model.
+    The adapter was trained on the base as loaded with `quantization_config`, so the base is loaded the same way and,
+    if quantized, dequantized before merging. The merged weights stay unquantized (float16 by default): quantizing
+    W + BA again would round most of the LoRA delta away.
+    :param save_path: directory to save the merged weights in, they are not saved if None.
+    :param attn_implementation: passed to from_pretrained, the default of transformers if None.
+    '''
+    model = model_class.from_pretrained(base_path, quantization_config=quantization_config,
+                                        torch_dtype=torch_dtype or torch.float16, low_cpu_mem_usage=True,
+                                        device_map=device, attn_implementation=attn_implementation)
+    if quantization_config is not None:
+        model = model.dequantize()
+        del model.config.quantization_config
+    model = PeftModel.from_pretrained(model, adapter_path).merge_and_unload()
+    if save_path is not None:
+        model.save_pretrained(save_path, safe_serialization=True)
+    return model
+
+
+class MessageEncoder(nn.Module):
+    '''
+    BERT and the projector as one module, the message-encoding half of LogLLM, used for export.
+    '''
+    def __init__(self, bert_model, projector):
+        super().__init__()
+        self.bert_model = bert_model
+        self.projector = projector
+
+    def forward(self, input_ids, attention_mask, token_type_ids):
+        outputs = self.bert_model(input_ids=input_ids, attention_mask=attention_mask,
+                                  token_type_ids=token_type_ids).pooler_output
+        return self.projector(outputs.float())
+
+
+class ExportedMessageEncoder:
+    '''
+    Runs a MessageEncoder exported by scripts/export_encoder.py on the CPU, as a replacement of BERT and the
+    projector in LogLLM (see LogLLM.set_message_encoder). '.onnx' files are run with onnxruntime, other files are
+    loaded as TorchScript.
+    '''
+    input_names = ('input_ids', 'attention_mask', 'token_type_ids')
+
+    def __init__(self, path, num_threads=None):
+        '''
+        :param num_threads: intra-op threads of the onnxruntime session. TorchScript modules use the threads of torch,
+                            set for the whole process by LogLLM(num_threads=...) or the entry script.
+        '''
+        self.path = path
+        if path.endswith('.onnx'):
+            import onnxruntime
+
+            options = onnxruntime.SessionOptions()
+            if num_threads is not None:
+                options.intra_op_num_threads = num_threads
+            self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+            self.module = None
+        else:
+            self.session = None
+            self.module = torch.jit.load(path, map_location='cpu').eval()
+
+    def __call__(self, inputs):
+        '''
+        :param inputs: BERT inputs of the messages, as produced by CustomCollator.
+        :return: float tensor of shape [number of messages, Llama hidden size] on the CPU.
+        '''
+        tensors = [inputs[name].cpu() for name in self.input_names]
+        if self.session is not None:
+            feed = {name: tensor.numpy() for name, tensor in zip(self.input_names, tensors)}
+            return torch.from_numpy(self.session.run(None, feed)[0])
+        with torch.no_grad():
+            return self.module(*tensors)
+
+
 class LogLLM(nn.Module):
-    def __init__(self, Bert_path, Llama_path, ft_path=None, is_train_mode=True, device = torch.device("cuda:0"), max_content_len = 128, max_seq_len = 128):
+    def __init__(self, Bert_path, Llama_path, ft_path=None, is_train_mode=True, device = torch.device("cuda:0"), max_content_len = 128, max_seq_len = 128,
+                 use_prefix_cache=True, embedding_cache_size=0, packed_training=False,
+                 cpu_dtype=torch.bfloat16, cpu_int8=False, num_threads=None, merge_adapters=False, merged_save_path=None,
+                 attn_implementation=None):
+        '''
+        On a CUDA device the models are loaded with the 4-bit NF4 `bnb_config`. On the CPU (device=torch.device("cpu"))
+        bitsandbytes is not used: the models are loaded in `cpu_dtype` (bfloat16 or float32), or, with `cpu_int8`
+        (inference only), the LoRA adapters are merged and the Linear layers get PyTorch dynamic int8 quantization
+        on top of float32. `num_threads` sets the number of intra-op threads of torch.
+        NF4, bfloat16 and int8 round the weights differently, so the anomaly probabilities of score() on the CPU differ
+        slightly from the GPU path; scripts/check_scores.py measures the deviation on a test set.
+
+        With `merge_adapters` (inference only) the Llama_ft and Bert_ft adapters of `ft_path` are merged into the base
+        weights, see load_merged_model; `merged_save_path` keeps the result as a standalone checkpoint
+        (Llama_merged/, Bert_merged/, projector.pt), which can later be passed as `ft_path` itself. Merged weights are
+        not quantized, on CUDA they are float16 (about 16 GB for Llama-3-8B instead of about 6 GB in NF4).
+
+        `attn_implementation` is passed to the from_pretrained of Llama ('eager', 'sdpa' or 'flash_attention_2', the
+        default of transformers if None). With 'flash_attention_2' (CUDA, flash-attn installed), packed_training
+        uses the variable-length kernels instead of a dense block-diagonal mask.
+        '''
         super().__init__()
         self.max_content_len = max_content_len  # max length of each log messages (contents)
         self.max_seq_len = max_seq_len   # max length of each log sequence  (log sequence contains some log messages)
         self.device = device
+        if device.type == 'cpu':
+            if num_threads is not None:
+                torch.set_num_threads(num_threads)
+            quantization_config = None
+            self.compute_dtype = torch.float32 if cpu_int8 else cpu_dtype  # dtype of the message embeddings
+            torch_dtype = self.compute_dtype
+        else:
+            if cpu_int8:
+                raise ValueError("'cpu_int8' requires device=torch.device('cpu').")
+            quantization_config = bnb_config
+            self.compute_dtype = torch.float16
+            torch_dtype = None
+
+        # a checkpoint written through merged_save_path already contains the adapters
+        is_merged_checkpoint = ft_path is not None and os.path.isdir(os.path.join(ft_path, 'Llama_merged'))
+        merge_adapters = merge_adapters and ft_path is not None and not is_merged_checkpoint
+        self.merged = is_merged_checkpoint or merge_adapters
+        if self.merged and is_train_mode:
+            raise ValueError('Merged adapters are only supported for inference (is_train_mode=False).')
+        if is_merged_checkpoint:
+            Llama_path = os.path.join(ft_path, 'Llama_merged')
+            Bert_path = os.path.join(ft_path, 'Bert_merged')
+            # quantizing the merged weights would round the LoRA delta away, see load_merged_model
+            quantization_config = None
+            torch_dtype = torch_dtype or torch.float16
+
         self.Llama_tokenizer = AutoTokenizer.from_pretrained(Llama_path, padding_side="right")
         self.Llama_tokenizer.pad_token = self.Llama_tokenizer.eos_token
-        self.Llama_model = AutoModelForCausalLM.from_pretrained(Llama_path, quantization_config=bnb_config,
-                                                           low_cpu_mem_usage=True,
-                                                           device_map=device)  # embedding dim = 4096
-
         self.Bert_tokenizer = BertTokenizerFast.from_pretrained(Bert_path, do_lower_case=True)
-        self.Bert_model = BertModel.from_pretrained(Bert_path, quantization_config=bnb_config, low_cpu_mem_usage=True,
-                                               device_map=device)
+
+        if merge_adapters:
+            print(f'Merging peft model from {ft_path}.')
+            self.Llama_model = load_merged_model(AutoModelForCausalLM, Llama_path, os.path.join(ft_path, 'Llama_ft'),
+                                                 quantization_config, torch_dtype, device,
+                                                 merged_save_path and os.path.join(merged_save_path, 'Llama_merged'),
+                                                 attn_implementation)
+            self.Bert_model = load_merged_model(BertModel, Bert_path, os.path.join(ft_path, 'Bert_ft'),
+                                                quantization_config, torch_dtype, device,
+                                                merged_save_path and os.path.join(merged_save_path, 'Bert_merged'))
+        else:
+            self.Llama_model = AutoModelForCausalLM.from_pretrained(Llama_path, quantization_config=quantization_config,
+                                                               torch_dtype=torch_dtype,
+                                                               low_cpu_mem_usage=True,
+                                                               device_map=device,
+                                                               attn_implementation=attn_implementation)  # embedding dim = 4096
+            self.Bert_model = BertModel.from_pretrained(Bert_path, quantization_config=quantization_config,
+                                                   torch_dtype=torch_dtype, low_cpu_mem_usage=True,
+                                                   device_map=device)
 
         self.projector = nn.Linear(self.Bert_model.config.hidden_size, self.Llama_model.config.hidden_size, device=device)
         # self.projector = nn.Linear(self.Bert_model.config.hidden_size, self.Llama_model.config.hidden_size).half().to(device)
 
-        self.instruc_tokens = self.Llama_tokenizer(
-            ['Below is a sequence of system log messages:', '. Is this sequence normal or anomalous? \\n'],
-            return_tensors="pt", padding=True).to(self.device)
+        self.instructions = ['Below is a sequence of system log messages:', '. Is this sequence normal or anomalous? \\n']
+
+        # KV cache of the instruction prefix (ins1), shared by all prompts; reset whenever the Llama weights change
+        self.use_prefix_cache = use_prefix_cache
+        self.prefix_cache = None
+        # train_helper packs the prompts of a batch into one row instead of padding them
+        self.packed_training = packed_training
+        # replaces BERT and the projector in inference when set, see set_message_encoder
+        self.message_encoder = None
+        # LRU cache of projected message embeddings used in inference (0 disables it)
+        self.embedding_cache = EmbeddingLRUCache(embedding_cache_size) if embedding_cache_size > 0 else None
+
+        self.answer_prefix = "The sequence is"
+        # constant parts of the prompts, tokenized once
+        self.prompt_builder = PromptBuilder(self.Llama_tokenizer, self.instructions, self.answer_prefix,
+                                            ['normal', 'anomalous'], self.device)
+        # ids of the first answer token where 'normal' and 'anomalous' differ, used by score()
+        self.answer_token_ids = first_diverging_token_ids(self.Llama_tokenizer, self.answer_prefix,
+                                                          [' normal.', ' anomalous.'])
+        # Platt scaling parameters applied to the anomalous-vs-normal logit margin
+        self.score_scale = 1.0
+        self.score_bias = 0.0
 
         # if is_train_mode:
         #     self.Bert_model = prepare_model_for_kbit_training(self.Bert_model)
         #     self.Llama_model = prepare_model_for_kbit_training(self.Llama_model)
 
-        if ft_path is not None:
-            print(f'Loading peft model from {ft_path}.')
-            Llama_ft_path = os.path.join(ft_path, 'Llama_ft')
-            Bert_ft_path = os.path.join(ft_path, 'Bert_ft')
-            projector_path = os.path.join(ft_path, 'projector.pt')
-            self.Llama_model = PeftModel.from_pretrained(
-                self.Llama_model,
-                Llama_ft_path,
-                is_trainable=is_train_mode,
-                torch_dtype=torch.float16,
-            )
-            self.Bert_model = PeftModel.from_pretrained(
-                self.Bert_model,
-                Bert_ft_path,
-                is_trainable=is_train_mode,
-                torch_dtype=torch.float16,
-            )
-            self.projector.load_state_dict(torch.load(projector_path, map_location=device, weights_only=True))
+        if self.merged:
+            self.load_projector(ft_path)
+            if merged_save_path is not None:
+                self.Llama_tokenizer.save_pretrained(os.path.join(merged_save_path, 'Llama_merged'))
+                self.Bert_tokenizer.save_pretrained(os.path.join(merged_save_path, 'Bert_merged'))
+                torch.save(self.projector.state_dict(), os.path.join(merged_save_path, 'projector.pt'))
+                self.save_score_calibration(os.path.join(merged_save_path, 'score_calibration.json'))
+        elif ft_path is not None:
+            self.load_ft_model(ft_path, is_train_mode=is_train_mode)
         else:
             print(f'Creating peft model.')
             Bert_peft_config = LoraConfig(task_type=TaskType.FEATURE_EXTRACTION,
@@ -146,6 +548,57 @@ class LogLLM(nn.Module):
             )
             self.Llama_model = get_peft_model(self.Llama_model, Llama_peft_config)
 
+        if cpu_int8:
+            if is_train_mode:
+                raise ValueError("'cpu_int8' is only supported for inference (is_train_mode=False).")
+            self.quantize_dynamic_int8()
+
+    def quantize_dynamic_int8(self):
+        '''
+        Merge the LoRA adapters into the base weights and apply PyTorch dynamic int8 quantization to every Linear
+        layer of Llama and BERT (CPU inference only).
+        '''
+        if isinstance(self.Llama_model, PeftModel):
+            self.Llama_model = self.Llama_model.merge_and_unload()
+        if isinstance(self.Bert_model, PeftModel):
+            self.Bert_model = self.Bert_model.merge_and_unload()
+        torch.ao.quantization.quantize_dynamic(self.Llama_model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+        torch.ao.quantization.quantize_dynamic(self.Bert_model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+        self.reset_caches()
+
+    def load_ft_model(self, ft_path, is_train_mode=False):
+        if self.merged:
+            raise ValueError('The adapters are merged into the weights, create a new LogLLM to load other ones.')
+        print(f'Loading peft model from {ft_path}.')
+        Llama_ft_path = os.path.join(ft_path, 'Llama_ft')
+        Bert_ft_path = os.path.join(ft_path, 'Bert_ft')
+        if isinstance(self.Llama_model, PeftModel):
+            # replace the weights of the adapters that are already attached
+            self.Llama_model.load_adapter(Llama_ft_path, adapter_name='default', is_trainable=is_train_mode)
+            self.Bert_model.load_adapter(Bert_ft_path, adapter_name='default', is_trainable=is_train_mode)
+        else:
+            self.Llama_model = PeftModel.from_pretrained(
+                self.Llama_model,
+                Llama_ft_path,
+                is_trainable=is_train_mode,
+                torch_dtype=torch.float16,
+            )
+            self.Bert_model = PeftModel.from_pretrained(
+                self.Bert_model,
+                Bert_ft_path,
+                is_trainable=is_train_mode,
+                torch_dtype=torch.float16,
+            )
+        self.load_projector(ft_path)
+
+    def load_projector(self, ft_path):
+        projector_path = os.path.join(ft_path, 'projector.pt')
+        self.projector.load_state_dict(torch.load(projector_path, map_location=self.device, weights_only=True))
+        calibration_path = os.path.join(ft_path, 'score_calibration.json')
+        if os.path.exists(calibration_path):
+            self.load_score_calibration(calibration_path)
+        self.reset_caches()
+
     def save_ft_model(self, path):
         if not os.path.exists(path):
             os.makedirs(path)
@@ -155,9 +608,11 @@ class LogLLM(nn.Module):
         self.Llama_model.save_pretrained(Llama_ft_path, safe_serialization = True)
         self.Bert_model.save_pretrained(Bert_ft_path, safe_serialization =True)
         torch.save(self.projector.state_dict(), projector_path)
+        self.save_score_calibration(os.path.join(path, 'score_calibration.json'))
 
 
     def set_train_only_projector(self):
+        self.reset_caches()
         for name, param in self.projector.named_parameters():
             param.requires_grad = True
         for name, param in self.Bert_model.named_parameters():
@@ -166,6 +621,7 @@ class LogLLM(nn.Module):
             param.requires_grad = False
 
     def set_train_only_Llama(self):
+        self.reset_caches()
         for name, param in self.projector.named_parameters():
             param.requires_grad = False
         for name, param in self.Bert_model.named_parameters():
@@ -175,6 +631,7 @@ class LogLLM(nn.Module):
                 param.requires_grad = True
 
     def set_train_projectorAndBert(self):
+        self.reset_caches()
         for name, param in self.projector.named_parameters():
             param.requires_grad = True
         for name, param in self.Bert_model.named_parameters():
@@ -185,6 +642,7 @@ class LogLLM(nn.Module):
 
 
     def set_finetuning_all(self):
+        self.reset_caches()
         for name, param in self.projector.named_parameters():
             param.requires_grad = True
         for name, param in self.Bert_model.named_parameters():
@@ -195,103 +653,331 @@ class LogLLM(nn.Module):
                 param.requires_grad = True
 
 
-    def train_helper(self, inputs, seq_positions, labels):
+    def train_helper(self, inputs, seq_positions, labels, inverse_indices=None, packed=None):
         '''
-        :param inputs: the tokenized Sequences for BERT. Sequences are concatenated.
+        :param inputs: the tokenized Sequences for BERT. Sequences are concatenated. Or, while BERT and the
+                       projector are frozen, their precomputed outputs, or, while BERT is frozen, the precomputed
+                       BERT outputs as {'pooler_output': tensor} (see EmbeddingTable); BERT is then skipped.
         :param: seq_positions:
         :param labels: np.array of labels, label is one of ['anomalous', 'normal']
-        :return: Llama_output[label_mask], target_tokens_ids[target_tokens_atts]
+        :param inverse_indices: see CustomCollator(deduplicate=True), None if the messages are not deduplicated.
+        :param packed: pack the prompts into one row without padding, defaults to self.packed_training.
+        :return: Llama_output[label_mask], target token ids
         '''
-        batch_size = len(labels)
+        if torch.is_tensor(inputs) and any(param.requires_grad for param in
+                                           chain(self.projector.parameters(), self.Bert_model.parameters())):
+            raise ValueError('Precomputed message embeddings can only be used while BERT and the projector are frozen.')
+        if not torch.is_tensor(inputs) and 'pooler_output' in inputs and \
+                any(param.requires_grad for param in self.Bert_model.parameters()):
+            raise ValueError('Precomputed BERT outputs can only be used while BERT is frozen.')
+        outputs = self._encode_messages(inputs, inverse_indices)
 
+        tail_index = self.prompt_builder.label_index(labels)
+        if self.packed_training if packed is None else packed:
+            return self._train_packed(outputs, seq_positions, tail_index)
 
-        outputs = self.Bert_model(**inputs).pooler_output  # dim = 768
-        outputs = outputs.float()
-        outputs = self.projector(outputs)
-        outputs = outputs.half()
-
-        seq_embeddings = torch.tensor_split(outputs, seq_positions)
-
-        prefix = "The sequence is "
-        max_len = max(len(s) for s in labels) + len(prefix)
-        labels = np.char.add(np.char.add(prefix, labels.astype(f'U{max_len}')), ".")
-        answer_tokens = self.Llama_tokenizer(list(labels), padding=True, return_tensors="pt").to(self.device)
+        llama_inputs = self._prepare_llama_inputs(outputs, seq_positions, tail_index)
+        label_mask, targets = self.prompt_builder.answer_masks(tail_index, llama_inputs['inputs_embeds'].shape[1])
 
-        target_tokens_ids = torch.cat([answer_tokens['input_ids'][:, 1:],
-                                       torch.full((batch_size, 1), self.Llama_tokenizer.eos_token_id, device=self.device)],
-                                      dim=-1)  # add eos token
-        target_tokens_atts = answer_tokens['attention_mask'].bool()
+        return self._answer_logits(llama_inputs, label_mask), targets
 
-        answer_tokens_ids = answer_tokens['input_ids'][:, 1:]  # remove bos token
-        answer_tokens_atts = answer_tokens['attention_mask'].bool()[:, 1:]
+    def _train_packed(self, message_embeddings, seq_positions, tail_index):
+        '''
+        Padding-free training step: the prompts of the batch are concatenated into one row and attend only to
+        themselves. With flash attention 2 (LogLLM(attn_implementation='flash_attention_2')) no mask is passed and
+        transformers takes the prompt boundaries from the position ids restarting at 0 (variable-length kernels);
+        otherwise a dense block-diagonal causal mask [1, 1, T, T] is passed to SDPA / eager attention.
+        '''
+        self.prompt_builder.embed(self._embed_tokens)
+        inputs_embeds, position_ids, segment_ids, label_mask = self.prompt_builder.build_packed(
+            message_embeddings, self._seq_lengths(seq_positions, message_embeddings), tail_index)
 
-        if type(self.Llama_model) == peft.peft_model.PeftModelForCausalLM:
-            instruc_embeddings = self.Llama_model.model.model.embed_tokens(self.instruc_tokens['input_ids'])
-            answer_embeddings = self.Llama_model.model.model.embed_tokens(answer_tokens_ids)
+        if self.Llama_model.config._attn_implementation == 'flash_attention_2':
+            attention_mask = None
         else:
-            instruc_embeddings = self.Llama_model.model.embed_tokens(self.instruc_tokens['input_ids'])
-            answer_embeddings = self.Llama_model.model.embed_tokens(answer_tokens_ids)
-
-        ins1 = instruc_embeddings[0][self.instruc_tokens['attention_mask'][0].bool()]
-        ins2 = instruc_embeddings[1][self.instruc_tokens['attention_mask'][1].bool()][1:]
-
-        embeddings = []
-        target_lens = []
-        for seq_embedding, answer_embedding, answer_tokens_att in zip(seq_embeddings, answer_embeddings,
-                                                                      answer_tokens_atts):
-            full_prompt_embedding = torch.cat([ins1, seq_embedding, ins2, answer_embedding[answer_tokens_att]])
-            target_lens.append(answer_tokens_att.sum())
-            embeddings.append(full_prompt_embedding)
+            total_len = segment_ids.shape[0]
+            allowed = (segment_ids[:, None] == segment_ids[None, :]) & \
+                torch.ones(total_len, total_len, dtype=torch.bool, device=segment_ids.device).tril()
+            attention_mask = torch.zeros((1, 1, total_len, total_len), dtype=inputs_embeds.dtype,
+                                         device=inputs_embeds.device)
+            attention_mask = attention_mask.masked_fill(~allowed, torch.finfo(inputs_embeds.dtype).min)
 
-        inputs_embeds, attention_mask = stack_and_pad_left(embeddings)
-        attention_mask = attention_mask.to(self.device)
-        label_mask = attention_mask.clone()
-        for i in range(label_mask.shape[0]):
-            label_mask[i, :-target_lens[i]-1] = 0
-        label_mask = label_mask.bool()
+        llama_inputs = {'inputs_embeds': inputs_embeds, 'attention_mask': attention_mask, 'position_ids': position_ids}
+        return self._answer_logits(llama_inputs, label_mask), self.prompt_builder.targets(tail_index)
 
-        Llama_output = self.Llama_model(inputs_embeds=inputs_embeds, attention_mask=attention_mask).logits
+    def _answer_logits(self, llama_inputs, label_mask):
+        '''
+        Run the Llama decoder and apply the LM head only at the answer positions, instead of materializing the
+        logits of every position of the prompts.
+        :return: logits at label_mask, shape [number of answer positions, vocabulary size].
+        '''
+        causal_lm = self.Llama_model.get_base_model() if isinstance(self.Llama_model, PeftModel) else self.Llama_model
+        hidden_states = causal_lm.model(**llama_inputs).last_hidden_state
+        return causal_lm.lm_head(hidden_states[label_mask])
 
-        return Llama_output[label_mask], target_tokens_ids[target_tokens_atts]
+    def _seq_lengths(self, seq_positions, message_embeddings):
+        bounds = torch.cat([torch.zeros(1, dtype=torch.long), torch.as_tensor(seq_positions, dtype=torch.long).cpu(),
+                            torch.tensor([message_embeddings.shape[0]])])
+        return bounds.diff().to(message_embeddings.device)
 
-    def forward(self, inputs, seq_positions):
+    def set_message_encoder(self, message_encoder):
         '''
-        :param inputs: the tokenized Sequences for BERT. Sequences are concatenated.
-        :param seq_positions:
-        :return: Generated answer (token id).
+        Encode the messages with `message_encoder` (e.g. an ExportedMessageEncoder) instead of BERT and the
+        projector, or go back to them with None. Inference only, gradients do not flow through it.
         '''
-        batch_size = len(seq_positions) + 1
-
-        outputs = self.Bert_model(**inputs).pooler_output  # dim = 768
+        self.message_encoder = message_encoder
+        self.reset_caches()
+
+    def _bert_project(self, inputs):
+        if 'pooler_output' in inputs:
+            # BERT outputs precomputed while BERT is frozen, see EmbeddingTable
+            outputs = inputs['pooler_output'].to(self.device)
+        elif self.message_encoder is not None:
+            return self.message_encoder(inputs).to(self.device, self.compute_dtype)
+        else:
+            outputs = self.Bert_model(**inputs).pooler_output  # dim = 768
         outputs = outputs.float()
         outputs = self.projector(outputs)
-        outputs = outputs.half()
+        outputs = outputs.to(self.compute_dtype)
+        return outputs
+
+    def _encode_messages(self, inputs, inverse_indices=None):
+        '''
+        Embed every log message with BERT and the projector. In inference, messages found in the embedding
+        cache are not sent through BERT again.
+        :param inverse_indices: if the collator deduplicated the messages, the index of each message of the
+                                batch in `inputs`.
+        :return: tensor of shape [number of messages, Llama hidden size].
+        '''
+        outputs = self._encode_unique_messages(inputs)
+        if inverse_indices is not None:
+            outputs = outputs[inverse_indices.to(outputs.device)]
+        return outputs
+
+    def encode_messages(self, inputs, project=True):
+        '''
+        Projected embeddings of tokenized messages (the BERT pooler outputs if not `project`), with BERT in eval mode
+        and without gradients, e.g. for EmbeddingTable.build.
+        '''
+        training = self.Bert_model.training
+        self.Bert_model.eval()
+        try:
+            with torch.no_grad():
+                inputs = inputs.to(self.device)
+                return self._bert_project(inputs) if project else self.Bert_model(**inputs).pooler_output
+        finally:
+            self.Bert_model.train(training)
+
+    def warm_start_projector(self, pooler_outputs, messages, n_epochs=1, lr=1e-3, batch_size=256):
+        '''
+        Cheap surrogate objective before projector-only training, without any Llama forward: fit the projector
+        output of every message to the mean Llama input embedding of its tokens (MSE), so that the projected
+        messages start in the region of the embedding space Llama reads its tokens from.
+        :param pooler_outputs: BERT pooler output of every message, e.g. EmbeddingTable(kind='pooler').embeddings.
+        :param messages: text of every message, in the same order.
+        :return: mean loss of the last epoch.
+        '''
+        optimizer = torch.optim.AdamW(self.projector.parameters(), lr=lr)
+        embed_tokens = self.Llama_model.get_input_embeddings()
+        epoch_loss = 0.0
+        for _ in range(n_epochs):
+            epoch_loss, num_batches = 0.0, 0
+            order = np.random.permutation(len(messages))
+            for start in range(0, len(messages), batch_size):
+                rows = order[start:start + batch_size]
+                tokens = self.Llama_tokenizer([messages[i] for i in rows], add_special_tokens=False, padding=True,
+                                              truncation=True, max_length=self.max_content_len, return_tensors='pt')
+                mask = tokens['attention_mask'].to(self.device).unsqueeze(-1).float()
+                with torch.no_grad():
+                    token_embeddings = embed_tokens(tokens['input_ids'].to(self.device)).float()
+                    targets = (token_embeddings * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+                inputs = torch.as_tensor(np.asarray(pooler_outputs[rows]), device=self.device).float()
+                loss = nn.functional.mse_loss(self.projector(inputs).float(), targets)
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+                epoch_loss += loss.item()
+                num_batches += 1
+            epoch_loss /= max(num_batches, 1)
+        self.reset_caches()
+        return epoch_loss
+
+    def _encode_unique_messages(self, inputs):
+        if torch.is_tensor(inputs):
+            # embeddings precomputed by encode_messages
+            return inputs.to(self.device, self.compute_dtype)
+        if self.embedding_cache is None or torch.is_grad_enabled() or self.Bert_model.training \
+                or 'pooler_output' in inputs:
+            return self._bert_project(inputs)
+
+        keys = message_keys(inputs)
+        rows = self.embedding_cache.lookup(keys)
+        hit_positions = [i for i, row in enumerate(rows) if row >= 0]
+        miss_keys = {}  # key -> positions of this missed message in the batch
+        for i, row in enumerate(rows):
+            if row < 0:
+                miss_keys.setdefault(keys[i], []).append(i)
+
+        if not miss_keys:
+            return self.embedding_cache.table[torch.tensor(rows, device=self.embedding_cache.table.device)]
+
+        first_positions = [positions[0] for positions in miss_keys.values()]
+        miss_outputs = self._bert_project(select_rows(inputs, torch.tensor(first_positions, device=self.device)))
+
+        outputs = torch.empty((len(keys), miss_outputs.shape[-1]), dtype=miss_outputs.dtype, device=miss_outputs.device)
+        if hit_positions:
+            hit_rows = torch.tensor([rows[i] for i in hit_positions], device=self.embedding_cache.table.device)
+            outputs[hit_positions] = self.embedding_cache.table[hit_rows]
+        miss_index = torch.repeat_interleave(torch.arange(len(miss_keys), device=outputs.device),
+                                             torch.tensor([len(p) for p in miss_keys.values()], device=outputs.device))
+        outputs[[i for positions in miss_keys.values() for i in positions]] = miss_outputs[miss_index]
+
+        self.embedding_cache.insert(list(miss_keys), miss_outputs)
+        return outputs
+
+    def _embed_tokens(self, token_ids):
+        return self.Llama_model.get_input_embeddings()(token_ids)
+
+    def reset_prefix_cache(self):
+        self.prefix_cache = None
+
+    def train(self, mode=True):
+        '''
+        Also drops the instruction prefix KV cache (eval() calls train(False)): the weights may have been updated
+        since it was computed.
+        '''
+        self.reset_prefix_cache()
+        return super().train(mode)
 
-        seq_embeddings = torch.tensor_split(outputs, seq_positions)
+    def reset_caches(self):
+        '''
+        Drop everything computed from the current weights, call after loading or training any of them.
+        '''
+        self.reset_prefix_cache()
+        self.prompt_builder.reset()
+        if self.embedding_cache is not None:
+            self.embedding_cache.clear()
 
-        prefix = "The sequence is"
-        answer_prefix_tokens = self.Llama_tokenizer(prefix, padding=True, return_tensors="pt")['input_ids'][0,1:].to(
-            self.device)
+    def _instruction_prefix_cache(self, batch_size):
+        '''
+        KV cache of the constant instruction prefix ins1, expanded to batch_size. Only used in eval mode: it is
+        computed once and reused for every batch, unless gradients flow into the Llama weights, in which case it is
+        recomputed (for a single row) and never stored.
+        '''
+        llama_trainable = torch.is_grad_enabled() and any(p.requires_grad for p in self.Llama_model.parameters())
+        reusable = not llama_trainable
+        if not reusable or self.prefix_cache is None:
+            with torch.set_grad_enabled(llama_trainable):
+                outputs = self.Llama_model(inputs_embeds=self.prompt_builder.ins1_embeds[None],
+                                           past_key_values=DynamicCache(), use_cache=True, num_logits_to_keep=1)
+            prefix_cache = outputs.past_key_values.to_legacy_cache()
+            if reusable:
+                self.prefix_cache = prefix_cache
+        else:
+            prefix_cache = self.prefix_cache
+        return DynamicCache.from_legacy_cache(tuple(
+            (key.expand(batch_size, -1, -1, -1), value.expand(batch_size, -1, -1, -1)) for key, value in prefix_cache))
 
-        if type(self.Llama_model) == peft.peft_model.PeftModelForCausalLM:
-            instruc_embeddings = self.Llama_model.model.model.embed_tokens(self.instruc_tokens['input_ids'])
-            answer_prefix_tokens_embeddings = self.Llama_model.model.model.embed_tokens(answer_prefix_tokens)
+    def _prepare_llama_inputs(self, message_embeddings, seq_positions, tail_index):
+        '''
+        Lay out the prompts as [ins1][padding][log sequence][tail], so that the instruction prefix is aligned in
+        every row and its KV cache can be shared. Position ids skip the padding, so the prompt is encoded exactly as
+        without it.
+        :param message_embeddings: embeddings of all messages of the batch, concatenated.
+        :param seq_positions: start of every sequence but the first in message_embeddings.
+        :param tail_index: see PromptBuilder.
+        :return: dict with inputs_embeds, attention_mask, position_ids and past_key_values.
+        '''
+        self.prompt_builder.embed(self._embed_tokens)
+        seq_lengths = self._seq_lengths(seq_positions, message_embeddings)
+
+        # in training mode every row keeps its own ins1, so that each row draws its own LoRA dropout mask
+        use_prefix_cache = self.use_prefix_cache and not self.training
+        inputs_embeds, attention_mask, position_ids = self.prompt_builder.build(
+            message_embeddings, seq_lengths, tail_index, include_prefix=not use_prefix_cache)
+        if use_prefix_cache:
+            past_key_values = self._instruction_prefix_cache(len(seq_lengths))
         else:
-            instruc_embeddings = self.Llama_model.model.embed_tokens(self.instruc_tokens['input_ids'])
-            answer_prefix_tokens_embeddings = self.Llama_model.model.embed_tokens(answer_prefix_tokens)
+            past_key_values = DynamicCache()
+        return {'inputs_embeds': inputs_embeds, 'attention_mask': attention_mask, 'position_ids': position_ids,
+                'past_key_values': past_key_values}
 
-        ins1 = instruc_embeddings[0][self.instruc_tokens['attention_mask'][0].bool()]
-        ins2 = instruc_embeddings[1][self.instruc_tokens['attention_mask'][1].bool()][1:]
+    def _build_inference_prompt(self, inputs, seq_positions, inverse_indices=None):
+        '''
+        Encode the log messages and assemble the prompts ending in "The sequence is".
+        :return: keyword arguments for self.Llama_model, see _prepare_llama_inputs.
+        '''
+        outputs = self._encode_messages(inputs, inverse_indices)
+        tail_index = torch.full((len(seq_positions) + 1,), self.prompt_builder.inference_tail, dtype=torch.long,
+                                device=outputs.device)
+        return self._prepare_llama_inputs(outputs, seq_positions, tail_index)
 
+    def score(self, inputs, seq_positions, return_margin=False, inverse_indices=None):
+        '''
+        Single-pass scoring: one prefill over the prompt, no decoding.
+        :param inputs: the tokenized Sequences for BERT. Sequences are concatenated.
+        :param seq_positions:
+        :param inverse_indices: see CustomCollator(deduplicate=True).
+        :param return_margin: also return the raw logit margin (anomalous - normal), e.g. for calibration.
+        :return: anomaly probability of each sequence, shape [batch_size].
+        '''
+        llama_inputs = self._build_inference_prompt(inputs, seq_positions, inverse_indices)
 
+        logits = self.Llama_model(**llama_inputs, num_logits_to_keep=1).logits[:, -1, :]
+        answer_logits = logits[:, self.answer_token_ids].float()   # [normal, anomalous]
+        margin = answer_logits[:, 1] - answer_logits[:, 0]
+        prob = torch.sigmoid(self.score_scale * margin + self.score_bias)
+        if return_margin:
+            return prob, margin
+        return prob
 
-        promot_embeddings = []
-        for seq_embedding in seq_embeddings:
-            prompt_embedding = torch.cat([ins1, seq_embedding, ins2, answer_prefix_tokens_embeddings])
-            promot_embeddings.append(prompt_embedding)
+    def fit_score_calibration(self, margins, labels, max_iter=100):
+        '''
+        Fit Platt scaling on logit margins from score(..., return_margin=True) of a held-out set.
+        :param margins: tensor or array of margins.
+        :param labels: 0/1 ground truth.
+        '''
+        margins = torch.as_tensor(margins, dtype=torch.float32).flatten().cpu()
+        labels = torch.as_tensor(labels, dtype=torch.float32).flatten().cpu()
+        scale = torch.ones(1, requires_grad=True)
+        bias = torch.zeros(1, requires_grad=True)
+        optimizer = torch.optim.LBFGS([scale, bias], lr=0.1, max_iter=max_iter)
+        criterion = nn.BCEWithLogitsLoss()
+
+        def closure():
+            optimizer.zero_grad()
+            loss = criterion(scale * margins + bias, labels)
+            loss.backward()
+            return loss
+
+        optimizer.step(closure)
+        self.score_scale = scale.item()
+        self.score_bias = bias.item()
+        return self.score_scale, self.score_bias
+
+    def save_score_calibration(self, path):
+        with open(path, 'w') as f:
+            json.dump({'scale': self.score_scale, 'bias': self.score_bias}, f)
+
+    def load_score_calibration(self, path):
+        with open(path) as f:
+            calibration = json.load(f)
+        self.score_scale = calibration['scale']
+        self.score_bias = calibration['bias']
+
+    def forward(self, inputs, seq_positions, inverse_indices=None):
+        '''
+        :param inputs: the tokenized Sequences for BERT. Sequences are concatenated.
+        :param seq_positions:
+        :param inverse_indices: see CustomCollator(deduplicate=True).
+        :return: Generated answer (token id).
+        '''
+        batch_size = len(seq_positions) + 1
 
-        inputs_embeds, attention_mask = stack_and_pad_left(promot_embeddings)
-        attention_mask = attention_mask.to(self.device)
+        llama_inputs = self._build_inference_prompt(inputs, seq_positions, inverse_indices)
+        attention_mask = llama_inputs['attention_mask']
+        position_ids = llama_inputs['position_ids']
+        past_key_values = llama_inputs['past_key_values']
 
         pad_token_id = self.Llama_tokenizer.pad_token_id
         eos_token_id = self.Llama_tokenizer.eos_token_id
@@ -303,23 +989,18 @@ class LogLLM(nn.Module):
 
         this_peer_finished = False
         answer = []
-        past_key_values = DynamicCache()  # 新缓存对象
-
 
         while not this_peer_finished:
-            if len(past_key_values) == 0:
-                # 初始轮：传完整 inputs_embeds
-                outputs = self.Llama_model(
-                    inputs_embeds=inputs_embeds,
-                    attention_mask=attention_mask,
-                    past_key_values=past_key_values,
-                    use_cache=True,
-                )
+            if len(answer) == 0:
+                # 初始轮：传完整 inputs_embeds（前缀的 KV 可能已在 past_key_values 中）
+                outputs = self.Llama_model(**llama_inputs, use_cache=True)
             else:
                 # 后续轮：只传一个 token 的 embedding（即上一步预测的 token）
+                position_ids = position_ids[:, -1:] + 1
                 outputs = self.Llama_model(
                     inputs_embeds=next_tokens_embeddings[:, None, :],
                     attention_mask=attention_mask,
+                    position_ids=position_ids,
                     past_key_values=past_key_values,
                     use_cache=True,
                 )
@@ -333,10 +1014,7 @@ class LogLLM(nn.Module):
             answer.append(next_tokens)
 
             # obtain embedding of next token
-            if isinstance(self.Llama_model, peft.peft_model.PeftModelForCausalLM):
-                next_tokens_embeddings = self.Llama_model.model.model.embed_tokens(next_tokens)
-            else:
-                next_tokens_embeddings = self.Llama_model.model.embed_tokens(next_tokens)
+            next_tokens_embeddings = self._embed_tokens(next_tokens)
 
             # update attention_mask
             attention_mask = torch.cat([attention_mask, unfinished_sequences[:, None]], dim=1)
@@ -1,139 +1,309 @@
 #see https://pinjiahe.github.io/papers/ISSRE16.pdf
+import io
 import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import numpy as np
 import pandas as pd
+import pyarrow as pa
 import re
 from datetime import datetime
 
 def fixedSize_window(raw_data, window_size, step_size):
-    aggregated = [
-        [raw_data['Content'].iloc[i:i + window_size].values,
-        max(raw_data['Label'].iloc[i:i + window_size]),
-         raw_data['Label'].iloc[i:i + window_size].values.tolist()
-         ]
-        for i in range(0, len(raw_data), step_size)
-    ]
+    """
+    split logs into fixed size windows of window_size messages, starting every step_size messages
+    :param raw_data: dataframe columns=[Content, Label]
+    :return: dataframe columns=[Content, Label, item_Label]: the messages of the window, its label (maximum label
+             of its messages) and the labels of its messages
+    """
+    contents = raw_data['Content'].values
+    labels = raw_data['Label'].values
+    starts, ends = fixedSize_window_indices(len(raw_data), window_size, step_size)
+    if len(starts) == 0:
+        return pd.DataFrame([], columns=list(raw_data.columns)+['item_Label'])
+    item_labels = labels.tolist()
+    aggregated = {
+        'Content': [contents[start:end] for start, end in zip(starts, ends)],
+        'Label': window_max(labels, starts, ends).tolist(),
+        'item_Label': [item_labels[start:end] for start, end in zip(starts, ends)],
+    }
     return pd.DataFrame(aggregated, columns=list(raw_data.columns)+['item_Label'])
 
 
+def fixedSize_window_indices(num_rows, window_size, step_size):
+    """ start and end (exclusive) of every fixed size window
+    """
+    starts = np.arange(0, num_rows, step_size, dtype=np.int64)
+    ends = np.minimum(starts + window_size, num_rows)
+    return starts, ends
+
+
+def window_max(values, starts, ends):
+    """ maximum of values[start:end] for every window, the windows must not be empty but may overlap
+    """
+    values = np.asarray(values)
+    if len(starts) == 0:
+        return values[:0]
+    # reduceat over interleaved [start, end) indices, a sentinel element makes end == len(values) a valid index
+    indices = np.empty(2 * len(starts), dtype=np.int64)
+    indices[0::2] = starts
+    indices[1::2] = ends
+    return np.maximum.reduceat(np.append(values, values[:1]), indices)[0::2]
+
+
+def fixedSize_window_bounds(labels, window_size, step_size):
+    """ [start, end) of every fixed size window, and its label (the maximum label of its messages)
+    :return: dataframe columns=[start, end, Label]
+    """
+    starts, ends = fixedSize_window_indices(len(labels), window_size, step_size)
+    return pd.DataFrame({'start': starts, 'end': ends, 'Label': window_max(labels, starts, ends)})
+
+
+def write_window_tables(output_dir, messages, windows, messages_file='messages.arrow'):
+    """ Write the log messages once and the windows as offsets into them, as uncompressed Arrow IPC files that
+    CustomDataset reads memory-mapped (instead of joining the messages of every window into train.csv/test.csv)
+    :param messages: dataframe of the messages, with a Content column (and e.g. Label, timestamp)
+    :param windows: {split name: dataframe with a Label column and either start/end columns (window of the
+                    messages [start, end)) or a message_ids column (list of message row numbers)}, written to
+                    <split>_windows.arrow
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    def write(table, path):
+        with pa.OSFile(path, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+
+    write(pa.Table.from_pandas(messages, preserve_index=False), os.path.join(output_dir, messages_file))
+    for split, window_df in windows.items():
+        table = pa.Table.from_pandas(window_df, preserve_index=False)
+        table = table.replace_schema_metadata({'messages': messages_file})
+        write(table, os.path.join(output_dir, '{}_windows.arrow'.format(split)))
+
 
 def sliding_window(raw_data, para):
     """
     split logs into time sliding windows
-    :param raw_data: dataframe columns=[timestamp, label, time duration, content]
+    :param raw_data: dataframe columns=[timestamp, label, time duration, content], sorted by timestamp
     :param para:{window_size: seconds, step_size: seconds}
-    :return: dataframe
+    :return: dataframe, windows in time order
     """
     log_size = raw_data.shape[0]
-    label_data, time_data = raw_data.iloc[:, 1], raw_data.iloc[:, 0]
-    deltaT_data = raw_data.iloc[:, 2]
-    content= raw_data.iloc[:, 3]
-
-    new_data = []
-    start_end_index_pair = set()
-
-    start_time = time_data[0]
-    end_time = start_time + para["window_size"]
-    start_index = 0
-    end_index = 0
+    time_data = raw_data.iloc[:, 0].values
+    label_data = raw_data.iloc[:, 1].values
+    deltaT_data = raw_data.iloc[:, 2].values
+    content = raw_data.iloc[:, 3].values
+    if log_size == 0:
+        return pd.DataFrame([], columns=list(raw_data.columns)+['item_Label'])
 
-    # get the first start, end index, end time
-    for cur_time in time_data:
-        if cur_time < end_time:
-            end_index += 1
-        else:
+    # start times t0, t0 + step, ... (accumulated as repeated additions) until a window reaches the last log
+    first_time, last_time = time_data[0], time_data[-1]
+    num_steps = max(int((last_time - first_time - para["window_size"]) // para["step_size"]), 0) + 2
+    while True:
+        start_times = np.cumsum(np.concatenate([[first_time], np.repeat(para["step_size"], num_steps)]))
+        end_indices = np.searchsorted(time_data, start_times + para["window_size"], side='left')
+        if end_indices[-1] == log_size:
             break
+        num_steps *= 2
+    num_windows = int(np.argmax(end_indices == log_size)) + 1
+    end_indices = end_indices[:num_windows]
+    start_indices = np.searchsorted(time_data, start_times[:num_windows], side='left')
+    start_indices[0] = 0
 
-    start_end_index_pair.add(tuple([start_index, end_index]))
-
-    # move the start and end index until next sliding window
-    num_session = 1
-    while end_index < log_size:
-        start_time = start_time + para['step_size']
-        end_time = start_time + para["window_size"]
-        for i in range(start_index, log_size):
-            if time_data[i] < start_time:
-                i += 1
-            else:
-                break
-        for j in range(end_index, log_size):
-            if time_data[j] < end_time:
-                j += 1
-            else:
-                break
-        start_index = i
-        end_index = j
+    # when start_index == end_index, there is no value in the window
+    pairs = np.stack([start_indices, end_indices], axis=1)
+    pairs = np.unique(pairs[pairs[:, 0] != pairs[:, 1]], axis=0)
+    starts, ends = pairs[:, 0], pairs[:, 1]
 
-        # when start_index == end_index, there is no value in the window
-        if start_index != end_index:
-            start_end_index_pair.add(tuple([start_index, end_index]))
-
-        num_session += 1
-        if num_session % 1000 == 0:
-            print("process {} time window".format(num_session), end='\r')
-
-    for (start_index, end_index) in start_end_index_pair:
-        dt = deltaT_data[start_index: end_index].values
+    item_labels = label_data.tolist()
+    new_data = []
+    for start_index, end_index, label in zip(starts, ends, window_max(label_data, starts, ends).tolist()):
+        dt = deltaT_data[start_index: end_index].copy()
         dt[0] = 0
         new_data.append([
-            time_data[start_index: end_index].values,
-            max(label_data[start_index:end_index]),
+            time_data[start_index: end_index],
+            label,
             dt,
-            content[start_index: end_index].values,
-            label_data[start_index:end_index].values.tolist(),
+            content[start_index: end_index],
+            item_labels[start_index: end_index],
         ])
 
-    assert len(start_end_index_pair) == len(new_data)
-    print('there are %d instances (sliding windows) in this dataset\n' % len(start_end_index_pair))
+    print('there are %d instances (sliding windows) in this dataset\n' % len(new_data))
     return pd.DataFrame(new_data, columns=list(raw_data.columns)+['item_Label'])
 
-def log_to_dataframe(log_file, regex, headers, start_line, end_line):
-    """ Function to transform log file to dataframe
-    """
-    log_messages = []
-    linecount = 0
-    cnt = 0
 
-    if end_line is None:
-        with open(log_file, 'r', encoding='latin-1') as fin:  # , encoding='latin-1'
-            while True:
-                line = fin.readline()
-                if not line:
-                    break
-                # for line in fin.readlines():
-                cnt += 1
-                try:
-                    match = regex.search(line.strip())
-                    message = [match.group(header) for header in headers]
-                    log_messages.append(message)
-                    linecount += 1
-                except Exception as e:
-                    # print("\n", line)
-                    # print(e)
-                    pass
+def _find_block_ids(contents, block_regex):
+    return pd.Series(contents).str.findall(block_regex).tolist()
+
 
+def group_by_block(contents, block_regex=r'blk_-?\d+', num_workers=1, chunk_size=1000000):
+    """
+    group the messages into sessions by the block ids they mention, in the order the original row loop built them:
+    blocks in order of first appearance (blocks first seen on the same message in set iteration order, as the loop
+    iterated set(re.findall(...))), the messages of every block in message order, a message mentioning a block
+    several times only once
+    :param contents: series of messages
+    :param num_workers: processes extracting the block ids, chunk_size messages at a time
+    :return: array of block ids, list of arrays with the row numbers of the messages of every block
+    """
+    contents = pd.Series(contents).reset_index(drop=True)
+    if num_workers > 1 and len(contents) > chunk_size:
+        chunks = [contents.values[i: i + chunk_size] for i in range(0, len(contents), chunk_size)]
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            found = [ids for chunk in executor.map(partial(_find_block_ids, block_regex=block_regex), chunks)
+                     for ids in chunk]
+        matches = pd.Series(found).explode().dropna()
     else:
-        line_pos = -1
-        with open(log_file, 'r', encoding='latin-1') as fin:
-            while True:
-                line = fin.readline()
-                line_pos += 1
-                if line_pos < start_line:
-                    continue
-                if not line or line_pos >= end_line:
+        matches = contents.str.findall(block_regex).explode().dropna()
+    pairs = pd.DataFrame({'row': matches.index.to_numpy(),
+                          'BlockId': matches.to_numpy()}).drop_duplicates(ignore_index=True)
+
+    multiple = pairs['row'].duplicated(keep=False).to_numpy()
+    if multiple.any():
+        block_ids = pairs['BlockId'].to_numpy(dtype=object).copy()
+        # a message appended itself to its blocks in the iteration order of the set of its block ids
+        line_starts = np.flatnonzero(np.diff(pairs['row'].to_numpy()[multiple])) + 1
+        block_ids[multiple] = [block_id for ids in np.split(block_ids[multiple], line_starts)
+                               for block_id in set(ids.tolist())]
+        pairs['BlockId'] = block_ids
+
+    codes, unique_ids = pd.factorize(pairs['BlockId'])
+    if len(unique_ids) == 0:
+        return np.asarray(unique_ids, dtype=object), []
+    rows = pairs['row'].to_numpy()[np.argsort(codes, kind='stable')]
+    return np.asarray(unique_ids, dtype=object), np.split(rows, np.cumsum(np.bincount(codes))[:-1])
+
+
+def _line_boundaries(block):
+    """ Offsets (in the block) of the line starts following a line break, with the line breaks of text mode:
+    '\n', '\r\n' and a lone '\r'
+    """
+    data = np.frombuffer(block, dtype=np.uint8)
+    starts = np.flatnonzero(data == 10) + 1
+    if b'\r' in block:
+        cr = np.flatnonzero(data == 13)
+        lone_cr = cr[(cr + 1 >= len(data)) | (data[np.minimum(cr + 1, len(data) - 1)] != 10)]
+        starts = np.sort(np.concatenate([starts, lone_cr + 1]))
+    return starts
+
+
+def build_line_index(log_file, step=100000, index_path=None, block_size=1 << 26):
+    """ Sparse line index of a log file: the byte offset of every `step`-th line and the number of lines, saved to
+    `index_path` and loaded from there while the log file is unchanged; with index_path=None, or when it cannot be
+    written, the index is only kept in memory
+    :return: (offsets, num_lines, step)
+    """
+    stat = os.stat(log_file)
+    if index_path is not None and os.path.exists(index_path):
+        index = np.load(index_path)
+        if (int(index['step']) == step and int(index['size']) == stat.st_size
+                and int(index['mtime_ns']) == stat.st_mtime_ns):
+            return index['offsets'], int(index['num_lines']), step
+
+    offsets = [np.zeros(1, dtype=np.int64)]
+    num_lines = 0  # line breaks seen so far
+    position = 0
+    last_start = 0
+    with open(log_file, 'rb') as fin:
+        while True:
+            block = fin.read(block_size)
+            if not block:
+                break
+            while block.endswith(b'\r'):  # keep '\r\n' in one block
+                extra = fin.read(1)
+                if not extra:
                     break
-                cnt += 1
-                try:
-                    match = regex.search(line.strip())
-                    message = [match.group(header) for header in headers]
-                    log_messages.append(message)
-                    linecount += 1
-                except Exception as e:
-                    # print("\n", line)
-                    # print(e)
-                    pass
+                block += extra
+            starts = _line_boundaries(block)
+            line_numbers = num_lines + 1 + np.arange(len(starts))
+            offsets.append(position + starts[line_numbers % step == 0])
+            if len(starts) > 0:
+                last_start = position + int(starts[-1])
+            num_lines += len(starts)
+            position += len(block)
+    if position > last_start:
+        num_lines += 1  # last line without a line break
 
-    print("Total size is {}; Total size after encoding is {}".format(linecount, cnt))
-    logdf = pd.DataFrame(log_messages, columns=headers)
+    offsets = np.concatenate(offsets).astype(np.int64)
+    if index_path is not None:
+        try:
+            np.savez(index_path, offsets=offsets, num_lines=num_lines, step=step, size=stat.st_size,
+                     mtime_ns=stat.st_mtime_ns)
+        except OSError as e:
+            print('Line index not saved ({}), keeping it in memory'.format(e))
+    return offsets, num_lines, step
+
+
+def iter_log_lines(log_file, start_line=0, end_line=None, index_step=100000, index_path=None, line_index=None):
+    """ Lines [start_line, end_line) of a log file, decoded as latin-1; the first line is reached with a seek
+    through the line index (see build_line_index) instead of reading every earlier line
+    :param line_index: (offsets, num_lines, step) of build_line_index if already built, built otherwise
+    """
+    if line_index is None:
+        line_index = build_line_index(log_file, step=index_step, index_path=index_path)
+    offsets, num_lines, step = line_index
+    end_line = num_lines if end_line is None else min(end_line, num_lines)
+    if start_line >= end_line:
+        return
+    checkpoint = start_line // step
+    with open(log_file, 'rb') as raw:
+        raw.seek(int(offsets[checkpoint]))
+        fin = io.TextIOWrapper(raw, encoding='latin-1')
+        line_pos = checkpoint * step
+        for line in fin:
+            if line_pos >= end_line:
+                break
+            if line_pos >= start_line:
+                yield line
+            line_pos += 1
+
+
+def parse_with_regex(regex, headers, line):
+    """ Fields of a stripped log line matched by the regex of generate_logformat_regex, None if it does not match
+    """
+    match = regex.search(line)
+    if match is None:
+        return None
+    return [match.group(header) for header in headers]
+
+
+def iter_log_chunks(log_file, parse, headers, start_line=0, end_line=None, chunk_size=1000000, index_path=None,
+                    line_index=None):
+    """ Parse lines [start_line, end_line) of a log file into dataframes of at most `chunk_size` lines each,
+    lines that do not match the log format are skipped
+    :param parse: function returning the fields of a stripped line or None, e.g. a LogFormatParser
+    """
+    log_messages = []
+    for cnt, line in enumerate(iter_log_lines(log_file, start_line, end_line, index_path=index_path,
+                                              line_index=line_index), start=1):
+        message = parse(line.strip())
+        if message is not None:
+            log_messages.append(message)
+        if cnt % chunk_size == 0:
+            yield pd.DataFrame(log_messages, columns=headers)
+            log_messages = []
+    if log_messages:
+        yield pd.DataFrame(log_messages, columns=headers)
+
+
+def log_to_dataframe(log_file, regex, headers, start_line, end_line, output_dir='.', index_path=None):
+    """ Function to transform log file to dataframe
+    The whole range is held in memory (twice while the chunks are concatenated); for large ranges use
+    iter_log_chunks, or write_structured_range / structure_log, whose memory is bounded by the chunk size
+    :param output_dir: where the line index is kept (index_path defaults to <output_dir>/<log name>.lineidx.npz),
+                       so that extracting another range of the same log does not scan it again
+    """
+    if index_path is None:
+        index_path = os.path.join(output_dir, os.path.basename(log_file) + '.lineidx.npz')
+    line_index = build_line_index(log_file, index_path=index_path)
+    chunks = list(iter_log_chunks(log_file, partial(parse_with_regex, regex, headers), headers, start_line, end_line,
+                                  line_index=line_index))
+    logdf = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame([], columns=headers)
+    offsets, num_lines, step = line_index
+    cnt = max(0, (num_lines if end_line is None else min(end_line, num_lines)) - start_line)
+    print("Total size is {}; Total size after encoding is {}".format(len(logdf), cnt))
     return logdf
 
 def generate_logformat_regex(logformat):
@@ -153,15 +323,102 @@ def generate_logformat_regex(logformat):
     regex = re.compile('^' + regex + '$')
     return headers, regex
 
-def structure_log(input_dir, output_dir, log_name, log_format,  start_line = 0, end_line = None):
+class LogFormatParser:
+    """ Parser of log lines without backtracking: for formats made of whitespace separated fields ending with
+    <Content>, optionally with a literal suffix before the content (HDFS: '<Component>: <Content>'), a line is
+    cut with str.split; lines that cannot be cut that way (fewer fields than the format, no literal suffix) and
+    all other formats go through the regex of generate_logformat_regex. Both give the same fields: with greedy
+    separators and lazy fields, the regex assigns one whitespace separated token to every field when there are
+    enough of them.
+    """
+    def __init__(self, logformat):
+        self.headers, self.regex = generate_logformat_regex(logformat)
+        splitters = re.split(r'(<[^<>]+>)', logformat)
+        separators = splitters[2:-1:2]
+        self.split_fields = None  # number of leading fields cut by str.split, None if only the regex is used
+        self.suffix = ''
+        if (splitters[0] == '' and splitters[-1] == '' and self.headers[-1] == 'Content'
+                and len(self.headers) >= 2 and all(separator.strip(' ') == '' and separator for separator in separators[:-1])):
+            last = separators[-1]
+            suffix = last.rstrip(' ')
+            if last != suffix and ' ' not in suffix and re.escape(suffix) == suffix:
+                self.suffix = suffix
+                self.split_fields = len(self.headers) - 2 if suffix else len(self.headers) - 1
+
+    def __call__(self, line):
+        if self.split_fields is None:
+            return parse_with_regex(self.regex, self.headers, line)
+        fields = line.split(maxsplit=self.split_fields)
+        if len(fields) != self.split_fields + 1:
+            return parse_with_regex(self.regex, self.headers, line)
+        if not self.suffix:
+            return fields
+
+        rest = fields[-1]
+        start = rest.find(self.suffix)
+        end = start + len(self.suffix)
+        while start >= 0 and not (end < len(rest) and rest[end].isspace()):
+            start = rest.find(self.suffix, start + 1)
+            end = start + len(self.suffix)
+        if start < 0:
+            return parse_with_regex(self.regex, self.headers, line)
+        fields[-1] = rest[:start]
+        fields.append(rest[end:].lstrip())
+        return fields
+
+
+def write_structured_range(log_file, log_format, start_line, end_line, output_path, index_path=None):
+    """ Parse lines [start_line, end_line) of a log file and append them to a CSV file without header
+    :return: number of parsed lines
+    """
+    parser = LogFormatParser(log_format)
+    linecount = 0
+    for df_log in iter_log_chunks(log_file, parser, parser.headers, start_line, end_line, index_path=index_path):
+        df_log.to_csv(output_path, mode='a', header=False, index=False, escapechar='\\')
+        linecount += len(df_log)
+    return linecount
+
+def structure_log(input_dir, output_dir, log_name, log_format,  start_line = 0, end_line = None, num_workers = 1):
+    """ Parse a log file into <log_name>_structured.csv; with num_workers > 1 the lines are split into
+    num_workers ranges (aligned on line starts through the line index) parsed by separate processes into
+    ordered shards, which are then concatenated; the output is the same as with one process
+    """
     print('Structuring file: ' + os.path.join(input_dir, log_name))
     start_time = datetime.now()
     headers, regex = generate_logformat_regex(log_format)
-    df_log = log_to_dataframe(os.path.join(input_dir, log_name), regex, headers, start_line, end_line)
 
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    df_log.to_csv(os.path.join(output_dir, log_name + '_structured.csv'), index=False, escapechar='\\')
+    log_file = os.path.join(input_dir, log_name)
+    # kept with the outputs, the input directory may be read-only or shared
+    index_path = os.path.join(output_dir, log_name + '.lineidx.npz')
+    offsets, num_lines, step = build_line_index(log_file, index_path=index_path)
+    end_line = num_lines if end_line is None else min(end_line, num_lines)
+    cnt = max(0, end_line - start_line)
+
+    # write the parsed lines chunk by chunk, so memory does not grow with the size of the log
+    output_path = os.path.join(output_dir, log_name + '_structured.csv')
+    pd.DataFrame([], columns=headers).to_csv(output_path, index=False, escapechar='\\')
+    if num_workers <= 1 or cnt == 0:
+        linecount = write_structured_range(log_file, log_format, start_line, end_line, output_path, index_path)
+    else:
+        bounds = np.linspace(start_line, start_line + cnt, num_workers + 1).astype(np.int64).tolist()
+        shard_paths = ['{}.part{}'.format(output_path, i) for i in range(num_workers)]
+        for shard_path in shard_paths:
+            if os.path.exists(shard_path):
+                os.remove(shard_path)
+        with ProcessPoolExecutor(num_workers) as executor:
+            linecounts = list(executor.map(write_structured_range, [log_file] * num_workers,
+                                           [log_format] * num_workers, bounds[:-1], bounds[1:], shard_paths,
+                                           [index_path] * num_workers))
+        linecount = sum(linecounts)
+        with open(output_path, 'ab') as fout:
+            for shard_path in shard_paths:
+                if os.path.exists(shard_path):
+                    with open(shard_path, 'rb') as fin:
+                        shutil.copyfileobj(fin, fout)
+                    os.remove(shard_path)
+    print("Total size is {}; Total size after encoding is {}".format(linecount, cnt))
 
     print('Structuring done. [Time taken: {!s}]'.format(datetime.now() - start_time))
@@ -1,21 +1,23 @@
 import os
-import re
-from collections import defaultdict
 
 import pandas as pd
-from tqdm import tqdm
 
-from prepareData.helper import structure_log
+from prepareData.helper import structure_log, write_window_tables, group_by_block
 
 data_dir = r'/hy-tmp/data/HDFS_data'
 log_name = "HDFS.log"
 
 output_dir = data_dir
+num_workers = os.cpu_count()   # processes parsing the raw log in structure_log and extracting the block ids
+shuffle_seed = None   # an int makes the train/test split reproducible
+# 'csv': train.csv/test.csv with the messages of every block joined by ' ;-; '
+# 'arrow': messages.arrow (every message once) + train_windows.arrow/test_windows.arrow (message ids of every block)
+output_format = 'csv'
 
 
 if __name__ == '__main__':
     log_format = '<Date> <Time> <Pid> <Level> <Component>: <Content>'  # HDFS log format
-    structure_log(data_dir, output_dir, log_name, log_format)
+    structure_log(data_dir, output_dir, log_name, log_format, num_workers=num_workers)
 
     spliter = ' ;-; '
     train_ratio = 0.8
@@ -28,50 +30,58 @@ if __name__ == '__main__':
     print(f'number of messages in {log_structured_file} is {len(df)}')
     # df = df[:100000]
 
-    data_dict_content = defaultdict(list) #preserve insertion order of items
-    for idx, row in tqdm(df.iterrows(),total=len(df)):
-        blkId_list = re.findall(r'(blk_-?\d+)', row['Content'])
-        blkId_set = set(blkId_list)
-        for blk_Id in blkId_set:
-            data_dict_content[blk_Id].append(row["Content"])
+    # sessions in the order the blocks first appear, with the messages of every block in log order
+    block_ids, block_rows = group_by_block(df['Content'], num_workers=num_workers)
 
-    data_df = pd.DataFrame(list(data_dict_content.items()), columns=['BlockId', 'Content'])
+    if output_format == 'arrow':
+        # row numbers of the messages of every block in df, the messages are written only once
+        data_df = pd.DataFrame({'BlockId': block_ids, 'message_ids': [rows.tolist() for rows in block_rows]})
+    else:
+        contents = df['Content'].to_numpy()
+        data_df = pd.DataFrame({'BlockId': block_ids, 'Content': [contents[rows].tolist() for rows in block_rows]})
 
-    blk_label_dict = {}
     blk_label_file = os.path.join(data_dir, "anomaly_label.csv")
-    blk_df = pd.read_csv(blk_label_file)
-    for _, row in tqdm(blk_df.iterrows(),total=len(blk_df)):
-        blk_label_dict[row["BlockId"]] = 1 if row["Label"] == "Anomaly" else 0
-
-    data_df["Label"] = data_df["BlockId"].apply(lambda x: blk_label_dict.get(x))  # add label to the sequence of each blockid
+    blk_df = pd.read_csv(blk_label_file).drop_duplicates('BlockId', keep='last')
+    blk_df['Label'] = (blk_df['Label'] == 'Anomaly').astype(int)
+    data_df = data_df.merge(blk_df[['BlockId', 'Label']], on='BlockId', how='left')  # add label to the sequence of each blockid
 
     train_len = int(train_ratio * len(data_df))
 
-    data_df = data_df.sample(frac=1).reset_index(drop=True)  ##shuffle
+    data_df = data_df.sample(frac=1, random_state=shuffle_seed).reset_index(drop=True)  ##shuffle
 
     session_train_df = data_df[:train_len]
 
     session_test_df = data_df[train_len:]
     session_test_df = session_test_df.reset_index(drop=True)
 
-    session_train_df['session_length'] = session_train_df["Content"].apply(len)
-    session_train_df["Content"] = session_train_df["Content"].apply(lambda x: spliter.join(x))
+    if output_format == 'arrow':
+        session_train_df['session_length'] = session_train_df['message_ids'].apply(len)
+    else:
+        session_train_df['session_length'] = session_train_df["Content"].apply(len)
+        session_train_df["Content"] = session_train_df["Content"].apply(lambda x: spliter.join(x))
 
     mean_session_train_len = session_train_df['session_length'].mean()
     max_session_train_len = session_train_df['session_length'].max()
     num_anomalous_train = session_train_df['Label'].sum()
     num_normal_train = len(session_train_df['Label']) - session_train_df['Label'].sum()
 
-    session_test_df['session_length'] = session_test_df["Content"].apply(len)
-    session_test_df["Content"] = session_test_df["Content"].apply(lambda x: spliter.join(x))
+    if output_format == 'arrow':
+        session_test_df['session_length'] = session_test_df['message_ids'].apply(len)
+    else:
+        session_test_df['session_length'] = session_test_df["Content"].apply(len)
+        session_test_df["Content"] = session_test_df["Content"].apply(lambda x: spliter.join(x))
 
     mean_session_test_len = session_test_df['session_length'].mean()
     max_session_test_len = session_test_df['session_length'].max()
     num_anomalous_test = session_test_df['Label'].sum()
     num_normal_test = len(session_test_df['Label']) - session_test_df['Label'].sum()
 
-    session_train_df.to_csv(os.path.join(output_dir, 'train.csv'), index=False)
-    session_test_df.to_csv(os.path.join(output_dir, 'test.csv'), index=False)
+    if output_format == 'arrow':
+        write_window_tables(output_dir, df[['Content']].assign(timestamp=df['Date'] + df['Time']),
+                            {'train': session_train_df, 'test': session_test_df})
+    else:
+        session_train_df.to_csv(os.path.join(output_dir, 'train.csv'), index=False)
+        session_test_df.to_csv(os.path.join(output_dir, 'test.csv'), index=False)
 
     print('Train dataset info:')
     print(f"max session length: {max_session_train_len}; mean session length: {mean_session_train_len}\n")
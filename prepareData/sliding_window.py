@@ -3,7 +3,7 @@ import os.path
 
 import numpy as np
 import pandas as pd
-from helper import sliding_window, fixedSize_window, structure_log
+from helper import sliding_window, fixedSize_window, fixedSize_window_bounds, structure_log, write_window_tables
 
 #### for Thunderbird, Liberty, BGL
 
@@ -23,6 +23,10 @@ end_line = None
 # end_line = 170000000
 
 output_dir = data_dir
+num_workers = os.cpu_count()   # processes parsing the raw log in structure_log
+# 'csv': train.csv/test.csv with the messages of every window joined by ' ;-; '
+# 'arrow': messages.arrow (every message once) + train_windows.arrow/test_windows.arrow ([start, end) of every window)
+output_format = 'csv'
 
 
 
@@ -49,7 +53,8 @@ if __name__ == '__main__':
         raise Exception('missing valid log format')
     print(f'Auto log_format: {log_format}')
 
-    structure_log(data_dir, output_dir, log_name, log_format, start_line = start_line, end_line = end_line)
+    structure_log(data_dir, output_dir, log_name, log_format, start_line = start_line, end_line = end_line,
+                  num_workers = num_workers)
 
     print(f'window_size: {window_size}; step_size: {step_size}')
 
@@ -77,17 +82,25 @@ if __name__ == '__main__':
 
     print('Start grouping.')
 
-    # grouping with fixedSize window
-    session_train_df = fixedSize_window(
-        df_train[['Content', 'Label']],
-        window_size=window_size, step_size=step_size
-    )
-
-    # grouping with fixedSize window
-    session_test_df = fixedSize_window(
-        df_test[['Content', 'Label']],
-        window_size=window_size, step_size=step_size
-    )
+    if output_format == 'arrow':
+        # windows as [start, end) rows of df, the messages are written only once
+        session_train_df = fixedSize_window_bounds(df_train['Label'].values, window_size, step_size)
+        session_test_df = fixedSize_window_bounds(df_test['Label'].values, window_size, step_size)
+        session_test_df[['start', 'end']] += train_len
+        messages_df = df[['Content', 'Label']].assign(timestamp=df['Id'])
+        write_window_tables(output_dir, messages_df, {'train': session_train_df, 'test': session_test_df})
+    else:
+        # grouping with fixedSize window
+        session_train_df = fixedSize_window(
+            df_train[['Content', 'Label']],
+            window_size=window_size, step_size=step_size
+        )
+
+        # grouping with fixedSize window
+        session_test_df = fixedSize_window(
+            df_test[['Content', 'Label']],
+            window_size=window_size, step_size=step_size
+        )
 
     # if group_type == 'time_sliding':
     #     # grouping with time sliding window
@@ -115,18 +128,24 @@ if __name__ == '__main__':
     col = ['Content', 'Label','item_Label']
     spliter=' ;-; '
 
-    session_train_df = session_train_df[col]
-    session_train_df['session_length'] = session_train_df["Content"].apply(len)
-    session_train_df["Content"] = session_train_df["Content"].apply(lambda x: spliter.join(x))
+    if output_format == 'arrow':
+        session_train_df['session_length'] = session_train_df['end'] - session_train_df['start']
+    else:
+        session_train_df = session_train_df[col]
+        session_train_df['session_length'] = session_train_df["Content"].apply(len)
+        session_train_df["Content"] = session_train_df["Content"].apply(lambda x: spliter.join(x))
 
     mean_session_train_len = session_train_df['session_length'].mean()
     max_session_train_len = session_train_df['session_length'].max()
     num_anomalous_train= session_train_df['Label'].sum()
     num_normal_train = len(session_train_df['Label']) - session_train_df['Label'].sum()
 
-    session_test_df = session_test_df[col]
-    session_test_df['session_length'] = session_test_df["Content"].apply(len)
-    session_test_df["Content"] = session_test_df["Content"].apply(lambda x: spliter.join(x))
+    if output_format == 'arrow':
+        session_test_df['session_length'] = session_test_df['end'] - session_test_df['start']
+    else:
+        session_test_df = session_test_df[col]
+        session_test_df['session_length'] = session_test_df["Content"].apply(len)
+        session_test_df["Content"] = session_test_df["Content"].apply(lambda x: spliter.join(x))
 
     mean_session_test_len = session_test_df['session_length'].mean()
     max_session_test_len = session_test_df['session_length'].max()
@@ -134,8 +153,9 @@ if __name__ == '__main__':
     num_normal_test = len(session_test_df['Label']) - session_test_df['Label'].sum()
 
 
-    session_train_df.to_csv(os.path.join(output_dir, 'train.csv'),index=False)
-    session_test_df.to_csv(os.path.join(output_dir, 'test.csv'),index=False)
+    if output_format != 'arrow':
+        session_train_df.to_csv(os.path.join(output_dir, 'train.csv'),index=False)
+        session_test_df.to_csv(os.path.join(output_dir, 'test.csv'),index=False)
 
     print('Train dataset info:')
     print(f"max session length: {max_session_train_len}; mean session length: {mean_session_train_len}\n")
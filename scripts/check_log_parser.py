@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+检查 prepareData.helper.LogFormatParser（基于 str.split）与 generate_logformat_regex 的正则解析结果一致
+
+对四个数据集（BGL、Thunderbird、Liberty、HDFS）的样例日志行和边界用例（多余空白、字段不足、缺少 ': ' 等）
+逐行比较两者的结果并统计单行解析耗时；可额外传入原始日志文件，检查其前 max_lines 行。不一致时以非 0 退出。
+
+使用方法:
+python scripts/check_log_parser.py
+python scripts/check_log_parser.py /path/to/BGL.log bgl
+"""
+
+import sys
+import timeit
+from itertools import islice
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'prepareData'))
+from helper import LogFormatParser, generate_logformat_regex, parse_with_regex
+
+max_lines = 1000000
+
+log_formats = {
+    'bgl': '<Label> <Id> <Date> <Code1> <Time> <Code2> <Component1> <Component2> <Level> <Content>',
+    'thunderbird': '<Label> <Id> <Date> <Admin> <Month> <Day> <Time> <AdminAddr> <Content>',
+    'liberty': '<Label> <Id> <Date> <Admin> <Month> <Day> <Time> <AdminAddr> <Content>',
+    'hdfs': '<Date> <Time> <Pid> <Level> <Component>: <Content>',
+}
+
+# 各数据集的典型日志行，走 str.split 快速路径
+typical_lines = {
+    'bgl': [
+        '- 1117838570 2005.06.03 R02-M1-N0-C:J12-U11 2005-06-03-15.42.50.675872 R02-M1-N0-C:J12-U11 RAS KERNEL INFO instruction cache parity error corrected',
+        'APPREAD 1117869872 2005.06.04 R04-M1-N4-I:J18-U11 2005-06-04-00.24.32.432192 R04-M1-N4-I:J18-U11 RAS APP FATAL ciod: failed to read message prefix on control stream (CioStream socket to 172.16.96.116:33569',
+        '- 1118536327 2005.06.11 R30-M0-N9-C:J16-U01 2005-06-11-17.32.07.581048 R30-M0-N9-C:J16-U01 RAS KERNEL INFO generating core.2275',
+    ],
+    'thunderbird': [
+        '- 1131566461 2005.11.09 dn228 Nov 9 12:01:01 dn228/dn228 crond(pam_unix)[2915]: session closed for user root',
+        '- 1131566463 2005.11.09 tbird-admin1 Nov 10 12:01:03 local@tbird-admin1 postfix/postdrop[10896]: warning: unable to look up public/pickup: No such file or directory',
+        'VAPI 1131567052 2005.11.09 tsqe2 Nov  9 12:10:52 tsqe2/tsqe2 kernel: [KERNEL_IB][ib_mad_dispatch][/mnt_projects/sysapps/src/ib/topspin/topspin-src-3.2.0-16/ib/ts_api_ng/mad/obj_host_amd64_custom1_rhel4/ts_ib_mad/mad_filter.c:43]Invalid MAD packet',
+    ],
+    'liberty': [
+        '- 1102911142 2004.12.12 ladmin1 Dec 12 20:12:22 ladmin1/ladmin1 sshd[23413]: Accepted publickey for root from 172.30.0.1 port 49733 ssh2',
+        'R_EXT_FS_IO 1103044946 2004.12.14 ln108 Dec 14 09:22:26 ln108/ln108 kernel: EXT3-fs error (device sda3): ext3_readdir: bad entry in directory #5193739',
+    ],
+    'hdfs': [
+        '081109 203615 148 INFO dfs.DataNode$PacketResponder: PacketResponder 1 for block blk_38865049064139660 terminating',
+        '081109 203807 222 INFO dfs.DataNode$PacketResponder: Received block blk_-6952295868487656571 of size 67108864 from /10.251.39.64',
+        '081109 204005 35 INFO dfs.FSNamesystem: BLOCK* NameSystem.addStoredBlock: blockMap updated: 10.251.73.220:50010 is added to blk_7128370237687728475 size 67108864',
+        '081109 204106 329 WARN dfs.DataNode$DataXceiver: 10.251.194.213:50010:Got exception while serving blk_-5815129211429447853 to /10.251.194.213:',
+    ],
+}
+
+# 边界用例：字段不足、多余空白、制表符、Unicode 空白、缺少 ': ' 等，部分走正则回退
+edge_lines = {
+    'bgl': [
+        '- 1117838570 2005.06.03 NULL 2005-06-03-15.42.50.675872 NULL RAS  KERNEL INFO',
+        '- 1117838570 2005.06.03 NULL 2005-06-03-15.42.50.675872 NULL RAS KERNEL INFO',
+    ],
+    'thunderbird': [
+        '- 1131566461 2005.11.09 dn228 Nov 9 12:01:01 dn228/dn228\tcrond[2915]:\t tab separated',
+        '- 1131566461 2005.11.09 dn228 Nov  9',
+    ],
+    'liberty': [
+        '- 1102911142 2004.12.12 ladmin1 Dec 12 20:12:22 ladmin1/ladmin1 x\x85y \xa0 nbsp',
+    ],
+    'hdfs': [
+        '081109 204106 329 WARN dfs.DataNode:: double colon',
+        '081109 204106 329 WARN :  empty component',
+        '081109 204106 329 WARN no colon at all',
+        '081109 204106 329 WARN:  colon on the level',
+        '081109  204106 329 WARN x: y',
+    ],
+}
+
+
+def compare(parser, regex, lines):
+    mismatches = 0
+    for line in lines:
+        line = line.strip()
+        expected = parse_with_regex(regex, parser.headers, line)
+        actual = parser(line)
+        if expected != actual:
+            mismatches += 1
+            if mismatches <= 5:
+                print(f'line:     {line!r}\nexpected: {expected}\nactual:   {actual}\n')
+    return mismatches
+
+
+def benchmark(parser, regex, lines, number=20):
+    lines = [line.strip() for line in lines]
+    regex_time = timeit.timeit(lambda: [parse_with_regex(regex, parser.headers, line) for line in lines], number=number)
+    split_time = timeit.timeit(lambda: [parser(line) for line in lines], number=number)
+    return regex_time / split_time
+
+
+if __name__ == '__main__':
+    failures = 0
+    for name, log_format in log_formats.items():
+        parser = LogFormatParser(log_format)
+        headers, regex = generate_logformat_regex(log_format)
+        lines = typical_lines[name] + edge_lines[name]
+        mismatches = compare(parser, regex, lines)
+        failures += mismatches
+        speedup = benchmark(parser, regex, typical_lines[name] * 100, number=5)
+        print(f'{name}: {len(lines) - mismatches}/{len(lines)} identical, split-based parser is {speedup:.1f}x faster')
+
+    if len(sys.argv) > 2:
+        log_file, name = sys.argv[1], sys.argv[2].lower()
+        parser = LogFormatParser(log_formats[name])
+        headers, regex = generate_logformat_regex(log_formats[name])
+        with open(log_file, 'r', encoding='latin-1') as fin:
+            lines = list(islice(fin, max_lines))
+        mismatches = compare(parser, regex, lines)
+        failures += mismatches
+        print(f'{log_file}: {len(lines) - mismatches}/{len(lines)} identical, '
+              f'split-based parser is {benchmark(parser, regex, lines, number=1):.1f}x faster')
+
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+检查 customDataset.normalize_windows 与 replace_patterns 的输出逐字节一致
+
+先检查一组边界用例（分隔符附近的 '...'、路径、日期、只含字母的十六进制串等），
+再检查数据集 CSV（如 train.csv / test.csv）的 Content 列。不一致时打印前几个例子并以非 0 退出。
+
+使用方法:
+python scripts/check_normalizer.py                       # 边界用例 + data_path
+python scripts/check_normalizer.py /path/to/test.csv     # 边界用例 + 指定的 CSV
+"""
+
+import os
+import sys
+from pathlib import Path
+
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from customDataset import replace_patterns, normalize_windows
+
+dataset_name = 'BGL'   # 'Thunderbird' 'HDFS_v1'  'BGL'  'Liberty'
+data_path = r'/mnt/public/gw/SyslogData/{}/test.csv'.format(dataset_name)
+num_workers = None
+max_examples = 5
+
+edge_cases = [
+    'RAS KERNEL INFO instruction cache parity error corrected ;-; ciod: failed to read message prefix',
+    'wait... ;-; done...;-; x ;-; ....',
+    'x...;-; y ;-; z',
+    'Jan 12 ;-; 12 Feb ;-; Mar  3 boot ;-; on Monday ;-; one two three',
+    'path /var/log/messages ;-; /usr/bin ;-; C:\\Windows\\system32 ;-; a/b;-;c/d ;-; [/x]',
+    'deadbeef ;-; DEADBEEFAB ;-; ab:cd:ef:ab:cd:ef ;-; aa:bb:cc:dd:ee:ff:aa:bb:cc:dd:ee:ff ;-; facade',
+    'user@host ;-; root@node-1.domain ;-; 10.0.0.1:8080 ;-; -1 ;-; a-1;-;1',
+    'True ;-; untrue ;-; Falsey ;-; falsehood ;-; none',
+    ' ;-;  ;-; ;-; ;-;;-; ',
+    '',
+]
+
+
+def compare(contents, num_workers=None):
+    expected = [replace_patterns(content) for content in contents]
+    actual = normalize_windows(contents, num_workers=num_workers)
+    mismatches = [(content, e, a) for content, e, a in zip(contents, expected, actual) if e != a]
+    for content, e, a in mismatches[:max_examples]:
+        print(f'input:    {content!r}\nexpected: {e!r}\nactual:   {a!r}\n')
+    return len(mismatches)
+
+
+if __name__ == '__main__':
+    path = sys.argv[1] if len(sys.argv) > 1 else data_path
+
+    failures = compare(edge_cases, num_workers=1)
+    print(f'edge cases: {len(edge_cases) - failures}/{len(edge_cases)} identical')
+
+    if os.path.exists(path):
+        contents = pd.read_csv(path)['Content'].values
+        mismatches = compare(contents, num_workers=num_workers)
+        print(f'{path}: {len(contents) - mismatches}/{len(contents)} identical')
+        failures += mismatches
+    else:
+        print(f'{path} not found, skipped')
+
+    sys.exit(1 if failures else 0)
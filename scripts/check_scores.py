@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+测量不同推理配置的 score() 输出与默认配置（device 上未合并的 peft 模型，CUDA 上为 NF4）的误差
+
+各模型在同一批测试序列上计算异常概率，打印最大/平均绝对误差和标签一致率：
+  - merge_adapters: 合并 LoRA 后的模型，最大误差超过 tolerance 时以非 0 退出。合并在反量化后的基座权重上进行、
+    结果保持 float16，误差只来自浮点舍入：CUDA（NF4 基座 + bf16 计算 vs float16 合并权重）下 tolerance 取 0.02，
+    CPU float32 下误差在 1e-4 以内。
+  - cpu_variants: CPU 推理路径（cpu_dtype bf16/fp32、cpu_int8），只打印误差；NF4、bf16 和 int8 对权重的舍入不同，
+    误差取决于模型和数据，以这里的实测值为准。
+
+使用方法:
+python scripts/check_scores.py                       # data_path 的前 num_samples 条序列
+python scripts/check_scores.py /path/to/test.csv     # 指定的测试集
+python scripts/check_scores.py /path/to/test.csv cpu # 同时测量 CPU 推理路径
+"""
+
+import gc
+import os
+import sys
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Subset
+from transformers import BertTokenizerFast
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from model import LogLLM
+from customDataset import CustomDataset, CustomCollator
+
+dataset_name = 'BGL'   # 'Thunderbird' 'HDFS_v1'  'BGL'  'Liberty'
+data_path = r'/mnt/public/gw/SyslogData/{}/test.csv'.format(dataset_name)
+Bert_path = r"/hy-tmp/model_weights/AI-ModelScope/bert-base-uncased"
+Llama_path = r"/hy-tmp/model_weights/LLM-Research/Meta-Llama-3-8B"
+ft_path = os.path.join(Path(__file__).resolve().parent.parent, r"ft_model_{}".format(dataset_name))
+
+max_content_len = 100
+max_seq_len = 128
+batch_size = 16
+num_samples = 512
+device = torch.device(os.environ.get('LOGLLM_DEVICE', 'cuda:0'))
+tolerance = 0.02   # merge_adapters 异常概率的最大绝对误差
+cpu_variants = {
+    'cpu bfloat16': dict(cpu_dtype=torch.bfloat16),
+    'cpu float32': dict(cpu_dtype=torch.float32),
+    'cpu int8': dict(cpu_int8=True),
+}
+
+
+def collect_scores(model, dataloader):
+    model.eval()
+    scores = []
+    with torch.no_grad():
+        for batch in dataloader:
+            probs = model.score(batch['inputs'].to(model.device), batch['seq_positions'],
+                                inverse_indices=batch.get('inverse_indices'))
+            scores.append(probs.float().cpu().numpy())
+    return np.concatenate(scores)
+
+
+def model_scores(dataloader, **kwargs):
+    kwargs.setdefault('device', device)
+    model = LogLLM(Bert_path, Llama_path, ft_path=ft_path, is_train_mode=False,
+                   max_content_len=max_content_len, max_seq_len=max_seq_len, **kwargs)
+    scores = collect_scores(model, dataloader)
+    del model
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    return scores
+
+
+def compare(reference, scores, name, threshold=0.5):
+    diff = np.abs(reference - scores)
+    agreement = ((reference >= threshold) == (scores >= threshold)).mean()
+    print(f'{name}: max abs diff {diff.max():.6f}, mean abs diff {diff.mean():.6f}, label agreement {agreement:.4f}')
+    return diff.max()
+
+
+if __name__ == '__main__':
+    path = sys.argv[1] if len(sys.argv) > 1 else data_path
+    check_cpu = len(sys.argv) > 2 and sys.argv[2] == 'cpu'
+    dataset = CustomDataset(path)
+    dataset = Subset(dataset, range(min(num_samples, len(dataset))))
+
+    tokenizer = BertTokenizerFast.from_pretrained(Bert_path, do_lower_case=True)
+    collator = CustomCollator(tokenizer, max_seq_len=max_seq_len, max_content_len=max_content_len, deduplicate=True)
+    dataloader = DataLoader(dataset, batch_size=batch_size, collate_fn=collator, shuffle=False)
+    reference = model_scores(dataloader)
+
+    max_diff = compare(reference, model_scores(dataloader, merge_adapters=True), 'merge_adapters')
+    print(f'tolerance: {tolerance}')
+    if check_cpu:
+        for name, kwargs in cpu_variants.items():
+            compare(reference, model_scores(dataloader, device=torch.device('cpu'), **kwargs), name)
+    sys.exit(0 if max_diff <= tolerance else 1)
@@ -9,7 +9,10 @@
 """
 
 import os
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 from pathlib import Path
 from tqdm import tqdm
 from datasets import load_from_disk
@@ -22,6 +25,11 @@ output_dir = "/Users/lc/PycharmProjects/LogLLM/data/HDFS_data"
 log_name = "HDFS.log"
 anomaly_label_file = "anomaly_label.csv"
 
+# 流式转换：按 batch_size 行的 Arrow record batch 遍历数据集，内存占用只与 batch 大小有关
+streaming = True
+batch_size = 100000
+log_columns = ['date', 'time', 'pid', 'level', 'component', 'content']
+
 def convert_hdfs_dataset():
     """
     将 HuggingFace datasets 格式转换为代码需要的格式
@@ -143,6 +151,115 @@ def convert_hdfs_dataset():
     print(f"3. 运行评估: python eval.py (设置 dataset_name = 'HDFS_v1')")
 
 
+def _column_as_text(batch, name):
+    """
+    与 str(row.get(name, '')) 相同的字符串列：缺失的列为 ''，字符串列的空值为 to_pandas() 后空值的 str()
+    （'None' 或 'nan'，取决于 pandas 版本），没有空值的整数列直接 cast，其他类型逐个调用 str()
+    """
+    if name not in batch.schema.names:
+        return pa.scalar('')
+    column = batch.column(name)
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks()
+    if pa.types.is_string(column.type) or pa.types.is_large_string(column.type):
+        return column.fill_null(str(pa.array([None], type=column.type).to_pandas()[0]))
+    if pa.types.is_integer(column.type) and column.null_count == 0:
+        return column.cast(pa.string())
+    return pa.array([str(value) for value in column.to_pandas().tolist()], type=pa.string())
+
+
+def _write_strings(f, strings):
+    """
+    把字符串数组的数据缓冲区（各元素首尾相连的 UTF-8 字节）一次写入，不逐行创建 Python 字符串
+    """
+    strings = strings.cast(pa.large_string())
+    if len(strings) == 0:
+        return
+    offsets = np.frombuffer(strings.buffers()[1], dtype=np.int64)[strings.offset: strings.offset + len(strings) + 1]
+    f.write(memoryview(strings.buffers()[2])[offsets[0]: offsets[-1]])
+
+
+def _block_anomaly_flags(batch):
+    """
+    一个 batch 内每个 BlockId 的异常标记：block_id 按空白切分为多个 BlockId 后展开，按 BlockId 分组，
+    任一行 anomaly == 1 即为异常；BlockId 按首次出现的顺序
+    """
+    flags = pd.DataFrame({'BlockId': pd.Series([], dtype=object), 'anomaly': pd.Series([], dtype=bool)})
+    if 'block_id' not in batch.schema.names:
+        return flags
+    block_ids = _column_as_text(batch, 'block_id')
+    block_lists = pc.utf8_split_whitespace(pc.if_else(pc.equal(block_ids, 'nan'), '', block_ids))
+    if 'anomaly' in batch.schema.names:
+        anomaly = batch.column('anomaly').to_numpy(zero_copy_only=False) == 1
+    else:
+        anomaly = np.zeros(len(batch), dtype=bool)
+    exploded = pd.DataFrame({'BlockId': pc.list_flatten(block_lists).to_numpy(zero_copy_only=False),
+                             'anomaly': anomaly[pc.list_parent_indices(block_lists).to_numpy()]})
+    exploded = exploded[exploded['BlockId'] != '']
+    if len(exploded) == 0:
+        return flags
+    return exploded.groupby('BlockId', sort=False, as_index=False)['anomaly'].max()
+
+
+def write_log_and_labels(batches, log_file_path):
+    """
+    逐个 Arrow record batch 用向量化的字符串操作拼出日志行并整块写入 HDFS.log，同一遍统计每个 BlockId 的标签
+    :param batches: 可迭代的 pyarrow.RecordBatch / pyarrow.Table
+    :return: (DataFrame[BlockId, Label]，BlockId 按首次出现的顺序，与 convert_hdfs_dataset 的结果一致; 日志行数)
+    """
+    block_flags = []
+    num_lines = 0
+    with open(log_file_path, 'wb', buffering=1 << 24) as f:
+        for batch in batches:
+            if len(batch) == 0:
+                continue
+            # 组合日志行：Date Time Pid Level Component: Content
+            date, time, pid, level, component, content = (_column_as_text(batch, name) for name in log_columns)
+            component = pc.binary_join_element_wise(component, ':', '')
+            lines = pc.binary_join_element_wise(date, time, pid, level, component, content, ' ')
+            _write_strings(f, pc.binary_join_element_wise(lines, '\n', ''))
+            block_flags.append(_block_anomaly_flags(batch))
+            num_lines += len(batch)
+
+    flags = pd.concat(block_flags, ignore_index=True) if block_flags else _block_anomaly_flags(pa.table({}))
+    flags = flags.groupby('BlockId', sort=False, as_index=False)['anomaly'].max()
+    label_df = pd.DataFrame({'BlockId': flags['BlockId'].to_numpy(dtype=object),
+                             'Label': np.where(flags['anomaly'].to_numpy(dtype=bool), 'Anomaly', 'Normal')})
+    return label_df, num_lines
+
+
+def convert_hdfs_dataset_streaming():
+    """
+    流式转换：不 to_pandas() 整个数据集，按 batch_size 行的 Arrow 表遍历各分割，输出与 convert_hdfs_dataset 相同
+    """
+    print("=" * 60)
+    print("HDFS_v1 数据集格式转换工具（流式）")
+    print("=" * 60)
+
+    ds = load_from_disk(input_dir)
+    print(f"数据集分割: {list(ds.keys())}")
+    total = sum(len(split_data) for split_data in ds.values())
+
+    def batches():
+        for split_name, split_data in ds.items():
+            print(f"处理分割: {split_name} ({len(split_data)} 条记录)")
+            yield from split_data.with_format('arrow').iter(batch_size=batch_size)
+
+    os.makedirs(output_dir, exist_ok=True)
+    log_file_path = os.path.join(output_dir, log_name)
+    label_file_path = os.path.join(output_dir, anomaly_label_file)
+    label_df, num_lines = write_log_and_labels(tqdm(batches(), total=-(-total // batch_size), desc="写入日志"),
+                                               log_file_path)
+    label_df.to_csv(label_file_path, index=False)
+
+    print(f"✅ 日志文件已保存: {log_file_path} ({num_lines} 行, "
+          f"{os.path.getsize(log_file_path) / (1024 * 1024):.2f} MB)")
+    print(f"✅ 标签文件已保存: {label_file_path}")
+    print(f"   共 {len(label_df)} 个 BlockId")
+    print(f"   异常数量: {(label_df['Label'] == 'Anomaly').sum()}")
+    print(f"   正常数量: {(label_df['Label'] == 'Normal').sum()}")
+
+
 if __name__ == '__main__':
     # 检查输入目录是否存在
     if not os.path.exists(input_dir):
@@ -151,5 +268,8 @@ if __name__ == '__main__':
         print(f"  python download_hdfs.py")
         exit(1)
     
-    convert_hdfs_dataset()
+    if streaming:
+        convert_hdfs_dataset_streaming()
+    else:
+        convert_hdfs_dataset()
 
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+导出消息编码器（合并 LoRA 后的 BERT + projector）为单个 TorchScript 或 ONNX 计算图，batch 和序列长度维度均为动态
+
+导出的文件可用 model.ExportedMessageEncoder 加载，并通过 LogLLM.set_message_encoder 替换进程内的 BERT + projector，
+在单独的 CPU worker 上编码日志消息，不占用 Llama 所在的设备。
+
+使用方法:
+python scripts/export_encoder.py                      # TorchScript (.pt)
+python scripts/export_encoder.py onnx                 # ONNX (.onnx)，需要 onnx；运行需要 onnxruntime
+"""
+
+import os
+import sys
+from pathlib import Path
+
+import torch
+from peft import PeftModel
+from transformers import BertModel, BertTokenizerFast
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+from model import MessageEncoder, ExportedMessageEncoder
+
+dataset_name = 'BGL'   # 'Thunderbird' 'HDFS_v1'  'BGL'  'Liberty'
+Bert_path = r"/hy-tmp/model_weights/AI-ModelScope/bert-base-uncased"
+ft_path = os.path.join(ROOT_DIR, r"ft_model_{}".format(dataset_name))
+output_dir = os.path.join(ROOT_DIR, r"encoder_{}".format(dataset_name))
+max_content_len = 100
+opset_version = 17
+
+
+def load_message_encoder(Bert_path, ft_path):
+    '''
+    从 ft_model_* 目录加载 BERT（LoRA 合并进权重，fp32）和 projector，支持 merged_save_path 保存的合并模型
+    '''
+    merged_path = os.path.join(ft_path, 'Bert_merged')
+    if os.path.isdir(merged_path):
+        bert_model = BertModel.from_pretrained(merged_path, attn_implementation='eager')
+    else:
+        bert_model = BertModel.from_pretrained(Bert_path, attn_implementation='eager')
+        bert_model = PeftModel.from_pretrained(bert_model, os.path.join(ft_path, 'Bert_ft')).merge_and_unload()
+
+    projector_state = torch.load(os.path.join(ft_path, 'projector.pt'), map_location='cpu', weights_only=True)
+    projector = torch.nn.Linear(*reversed(projector_state['weight'].shape))
+    projector.load_state_dict(projector_state)
+    return MessageEncoder(bert_model.float(), projector.float()).eval()
+
+
+def export_message_encoder(encoder, tokenizer, path, max_content_len=100, opset_version=17):
+    '''
+    以两条不同长度的消息为样例导出 encoder，格式由文件后缀决定（.onnx 或 TorchScript）
+    '''
+    sample = tokenizer(['instruction cache parity error corrected', 'ciod: failed to read message prefix'],
+                       return_tensors='pt', max_length=max_content_len, padding=True, truncation=True)
+    args = tuple(sample[name] for name in ExportedMessageEncoder.input_names)
+
+    with torch.no_grad():
+        if path.endswith('.onnx'):
+            dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in ExportedMessageEncoder.input_names}
+            dynamic_axes['embeddings'] = {0: 'batch'}
+            torch.onnx.export(encoder, args, path, input_names=list(ExportedMessageEncoder.input_names),
+                              output_names=['embeddings'], dynamic_axes=dynamic_axes, opset_version=opset_version,
+                              dynamo=False)
+        else:
+            torch.jit.trace(encoder, args).save(path)
+
+
+def check_export(encoder, tokenizer, path, max_content_len=100):
+    '''
+    用与导出样例不同的 batch 大小和序列长度比较导出模型与原模型的输出
+    '''
+    messages = ['RAS KERNEL INFO generating core', 'PacketResponder <*> for block <*> terminating',
+                'Receiving block <*> src: <*> dest: <*> with a considerably longer message']
+    inputs = tokenizer(messages, return_tensors='pt', max_length=max_content_len, padding=True, truncation=True)
+    with torch.no_grad():
+        expected = encoder(*(inputs[name] for name in ExportedMessageEncoder.input_names))
+    actual = ExportedMessageEncoder(path)(inputs)
+    max_diff = (expected - actual).abs().max().item()
+    print(f'max abs diff: {max_diff:.2e}')
+    return max_diff
+
+
+if __name__ == '__main__':
+    export_format = sys.argv[1] if len(sys.argv) > 1 else 'torchscript'
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, 'message_encoder.onnx' if export_format == 'onnx' else 'message_encoder.pt')
+
+    tokenizer = BertTokenizerFast.from_pretrained(Bert_path, do_lower_case=True)
+    encoder = load_message_encoder(Bert_path, ft_path)
+    export_message_encoder(encoder, tokenizer, path, max_content_len, opset_version)
+    print(f'exported to {path}')
+    check_export(encoder, tokenizer, path, max_content_len)
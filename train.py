@@ -1,12 +1,14 @@
 import os
+from functools import partial
 from pathlib import Path
 import numpy as np
 import torch
 from tqdm import tqdm
 from torch import nn
 from model import LogLLM
-from torch.utils.data import DataLoader
-from customDataset import CustomDataset, CustomCollator, BalancedSampler
+from torch.utils.data import DataLoader, Subset
+from customDataset import CustomDataset, CustomCollator, BalancedSampler, LengthBucketBatchSampler, TokenStore, \
+    WindowShards, StreamingWindowDataset, EmbeddingTable
 from torch import optim
 
 
@@ -28,14 +30,40 @@ max_content_len = 100
 max_seq_len = 128
 
 data_path = r'/mnt/public/gw/SyslogData/{}/train.csv'.format(dataset_name)
+# data_path = r'/mnt/public/gw/SyslogData/{}/train_windows.arrow'.format(dataset_name)   # prepareData output_format = 'arrow'
 
 min_less_portion = 0.3
+bucket_by_length = True   # batch sequences of similar length together (inside buckets of BalancedSampler indices)
+packed_training = False   # pack the prompts of a micro-batch into one row without padding
+# attention of Llama, None for the default of transformers; 'flash_attention_2' (requires flash-attn) lets
+# packed_training use variable-length kernels instead of a dense block-diagonal mask
+attn_implementation = None
 
 Bert_path = r"/hy-tmp/model_weights/AI-ModelScope/bert-base-uncased"
 Llama_path = r"/hy-tmp/model_weights/LLM-Research/Meta-Llama-3-8B"
 
 ROOT_DIR = Path(__file__).parent
 ft_path = os.path.join(ROOT_DIR, r"ft_model_{}".format(dataset_name))
+# memmap storage of the sequences shared by the DataLoader workers (None keeps them as Python lists)
+storage_dir = os.path.join(ROOT_DIR, r"cache_{}".format(dataset_name), 'train_sequences')
+pretokenize = True   # tokenize every unique message once into a TokenStore in storage_dir (requires storage_dir)
+# phase 1 (BERT and projector frozen): encode every unique message once into a float16 EmbeddingTable in storage_dir
+# and train Llama on these vectors, without BERT (requires pretokenize)
+precompute_embeddings = True
+# phase 2-1 (only the projector trained): cache the BERT pooler output of every unique message once in storage_dir
+# and train the projector on it, without BERT (requires pretokenize)
+cache_pooler_outputs = True
+# before phase 2-1, fit the projector to the mean Llama token embeddings of every message (requires cache_pooler_outputs)
+projector_warm_start = False
+# stream the windows from normalized shards in shard_dir (StreamingWindowDataset) instead of loading them all, for
+# datasets that do not fit in memory; bucket_by_length and pretokenize are not used
+streaming = False
+shard_dir = os.path.join(ROOT_DIR, r"cache_{}".format(dataset_name), 'train_shards')
+shard_size = 100000
+shuffle_buffer_size = 10000
+# hold this portion of the windows out of training and fit the Platt scaling of LogLLM.score() on it, saved with the
+# checkpoint (0 leaves the scores uncalibrated); not available with streaming
+calibration_portion = 0.05
 
 device = torch.device("cuda:0")
 
@@ -53,6 +81,14 @@ f'lr_3: {lr_3}\n'
 f'max_content_len: {max_content_len}\n'
 f'max_seq_len: {max_seq_len}\n'
 f'min_less_portion: {min_less_portion}\n'
+f'bucket_by_length: {bucket_by_length}\n'
+f'packed_training: {packed_training}\n'
+f'attn_implementation: {attn_implementation}\n'
+f'streaming: {streaming}\n'
+f'precompute_embeddings: {precompute_embeddings}\n'
+f'cache_pooler_outputs: {cache_pooler_outputs}\n'
+f'projector_warm_start: {projector_warm_start}\n'
+f'calibration_portion: {calibration_portion}\n'
 f'device: {device}')
 
 def print_number_of_trainable_model_parameters(model):
@@ -101,7 +137,8 @@ def trainModel(model, dataloader, gradient_accumulation_steps, n_epochs, lr):
             inputs = inputs.to(device)
             seq_positions = seq_positions
 
-            outputs, targets = model.train_helper(inputs, seq_positions, labels)
+            outputs, targets = model.train_helper(inputs, seq_positions, labels,
+                                                  inverse_indices=bathc_i.get('inverse_indices'))
 
             loss = criterion(outputs, targets)
             loss = loss / gradient_accumulation_steps
@@ -145,42 +182,104 @@ def trainModel(model, dataloader, gradient_accumulation_steps, n_epochs, lr):
                   f"[loss: {train_loss_epoch:3f}]"
                   f"[acc: {train_acc_epoch:3f}]")
 
+def calibrate_scores(model, dataloader, labels):
+    '''
+    Fit the Platt scaling of model.score() on the logit margins of held-out windows.
+    '''
+    model.eval()
+    margins = []
+    with torch.no_grad():
+        for bathc_i in tqdm(dataloader, desc='Calibration'):
+            _, margin = model.score(bathc_i['inputs'].to(device), bathc_i['seq_positions'], return_margin=True,
+                                    inverse_indices=bathc_i.get('inverse_indices'))
+            margins.append(margin)
+    scale, bias = model.fit_score_calibration(torch.cat(margins), labels)
+    print(f'score calibration: scale {scale:3f}, bias {bias:3f}')
+
 if __name__ == '__main__':
     print(f'dataset: {data_path}')
-    dataset = CustomDataset(data_path, drop_duplicates=False)
-
-    model = LogLLM(Bert_path, Llama_path, device = device, max_content_len = max_content_len, max_seq_len = max_seq_len)
+    train_indices, calibration_indices = None, None
+    if streaming:
+        shards = WindowShards.build(data_path, shard_dir, shard_size=shard_size)
+    else:
+        dataset = CustomDataset(data_path, drop_duplicates=False, storage_dir=storage_dir)
+        if calibration_portion > 0:
+            permutation = np.random.RandomState(0).permutation(len(dataset))
+            num_calibration = int(len(dataset) * calibration_portion)
+            calibration_indices = np.sort(permutation[:num_calibration])
+            train_indices = np.sort(permutation[num_calibration:])
+
+    model = LogLLM(Bert_path, Llama_path, device = device, max_content_len = max_content_len, max_seq_len = max_seq_len,
+                   packed_training = packed_training, attn_implementation = attn_implementation)
     # model = LogLLM(Bert_path, Llama_path, ft_path= ft_path, device = device, max_content_len = max_content_len, max_seq_len = max_seq_len)
 
     tokenizer = model.Bert_tokenizer
-    collator = CustomCollator(tokenizer, max_seq_len=max_seq_len, max_content_len=max_content_len)
-
-    dataloader_max_samples = DataLoader(
-        dataset,
-        batch_size=micro_batch_size,
-        num_workers=4,
-        sampler=BalancedSampler(dataset, target_ratio=min_less_portion, max_samples=1000),
-        collate_fn=collator,
-        drop_last=True
-    )
+    token_store = None
+    if pretokenize and storage_dir is not None and not streaming:
+        token_store = TokenStore.build(dataset.sequences, tokenizer, max_content_len,
+                                       os.path.join(storage_dir, 'bert_tokens'))
+        dataset.return_message_ids = True
+    collator = CustomCollator(tokenizer, max_seq_len=max_seq_len, max_content_len=max_content_len, deduplicate=True,
+                              token_store=token_store)
+
+    def make_dataloader(target_ratio, max_samples=None, collate_fn=collator):
+        if streaming:
+            return DataLoader(
+                StreamingWindowDataset(shards, target_ratio=target_ratio, max_samples=max_samples,
+                                       shuffle_buffer_size=shuffle_buffer_size, num_workers=4,
+                                       batch_size=micro_batch_size),
+                batch_size=micro_batch_size,
+                num_workers=4,
+                collate_fn=collate_fn,
+                drop_last=True
+            )
+        sampler = BalancedSampler(dataset, target_ratio=target_ratio, max_samples=max_samples, indices=train_indices)
+        if bucket_by_length:
+            return DataLoader(
+                dataset,
+                batch_sampler=LengthBucketBatchSampler(dataset, micro_batch_size, sampler=sampler,
+                                                       max_seq_len=max_seq_len, drop_last=True),
+                num_workers=4,
+                collate_fn=collate_fn,
+            )
+        return DataLoader(
+            dataset,
+            batch_size=micro_batch_size,
+            num_workers=4,
+            sampler=sampler,
+            collate_fn=collate_fn,
+            drop_last=True
+        )
+
     # phase 1
     print("*" * 10 + "Start training Llama" + "*" * 10)
     model.set_train_only_Llama()
+    phase_1_collator = collator
+    if precompute_embeddings and token_store is not None:
+        embedding_table = EmbeddingTable.build(token_store, model.encode_messages,
+                                               os.path.join(storage_dir, 'embeddings'))
+        phase_1_collator = CustomCollator(tokenizer, max_seq_len=max_seq_len, max_content_len=max_content_len,
+                                          deduplicate=True, embedding_table=embedding_table)
+    dataloader_max_samples = make_dataloader(min_less_portion, max_samples=1000, collate_fn=phase_1_collator)
     trainModel(model, dataloader_max_samples, gradient_accumulation_steps, n_epochs_1, lr_1)
     del dataloader_max_samples
 
-    dataloader = DataLoader(
-        dataset,
-        batch_size=micro_batch_size,
-        num_workers=4,
-        sampler=BalancedSampler(dataset, target_ratio=min_less_portion),
-        collate_fn=collator,
-        drop_last=True
-    )
+    dataloader = make_dataloader(min_less_portion)
     # phase 2-1
     print("*" * 10 + "Start training projector" + "*" * 10)
     model.set_train_only_projector()
-    trainModel(model, dataloader, gradient_accumulation_steps, n_epochs_2_1, lr_2_1)
+    dataloader_2_1 = dataloader
+    if cache_pooler_outputs and token_store is not None:
+        pooler_table = EmbeddingTable.build(token_store, partial(model.encode_messages, project=False),
+                                            os.path.join(storage_dir, 'pooler_outputs'), kind='pooler')
+        if projector_warm_start:
+            messages = [dataset.sequences.message(i) for i in range(dataset.sequences.num_messages())]
+            print(f'projector warm start loss: {model.warm_start_projector(pooler_table.embeddings, messages):3f}')
+        dataloader_2_1 = make_dataloader(min_less_portion, collate_fn=CustomCollator(
+            tokenizer, max_seq_len=max_seq_len, max_content_len=max_content_len, deduplicate=True,
+            embedding_table=pooler_table))
+    trainModel(model, dataloader_2_1, gradient_accumulation_steps, n_epochs_2_1, lr_2_1)
+    del dataloader_2_1
     # phase 2-2
     print("*" * 10 + "Start training projector and Bert" + "*" * 10)
     model.set_train_projectorAndBert()
@@ -190,4 +289,9 @@ if __name__ == '__main__':
     print("*" * 10 + "Start training entire model" + "*" * 10)
     trainModel(model, dataloader, gradient_accumulation_steps, n_epochs_3, lr_3)
 
+    if calibration_indices is not None:
+        calibration_dataloader = DataLoader(Subset(dataset, calibration_indices), batch_size=micro_batch_size,
+                                            num_workers=4, collate_fn=collator)
+        calibrate_scores(model, calibration_dataloader, dataset.get_label()[calibration_indices])
+
     model.save_ft_model(ft_path)
\ No newline at end of file